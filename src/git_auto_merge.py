@@ -2,18 +2,35 @@
 import json
 import os
 import re
+import shutil
+import subprocess
 import sys
+import time
 from subprocess import CalledProcessError
 from typing import Optional, Self
 
 import click
-import jsonpickle
-from loguru import logger as log
-from packaging.version import Version
 
+import maintenance
+import plan_config
+import plan_graph
+import refs
+import scheduler
+import sharding
+import status
+import transport
 import utils
+from plan_config import ForEachRule, PlanNode, Selector
+from scheduler import Scheduler
+from utils import log
 
 SEMVER_PATTERN = r"(\d+\.\d+\.\d+)"
+REPORTS_DIR = "reports"
+# dry-run merge results are kept here for inspection instead of in refs/heads
+DRY_RUN_REFS = "refs/git-auto-merge/dry-run/"
+
+# absolute path of this run's JSON Lines report, set by start_report
+report_stream_path: str | None = None
 
 
 class MergeItem:
@@ -57,6 +74,7 @@ class MergeItem:
 class VersionedBranch:
     name = ""
     version = ""
+    parsed_version = None
 
     def __init__(self, name):
         assert name is not None and name != ""
@@ -71,8 +89,15 @@ class VersionedBranch:
     def __str__(self):
         return self.name
 
+    def sort_key(self):
+        if self.parsed_version is None:
+            from packaging.version import Version  # noqa: PLC0415
+
+            self.parsed_version = Version(self.version)
+        return self.parsed_version
+
     def __lt__(self, item):
-        return Version(self.version) < Version(item.version)
+        return self.sort_key() < item.sort_key()
 
 
 class MergeError:
@@ -80,6 +105,7 @@ class MergeError:
     merge_to = ""
     error: CalledProcessError | None = None
     conflict = False
+    timed_out = False
     emails = []
 
     def __init__(self, merge_from, merge_to, error, conflict=False, emails=None):
@@ -87,15 +113,24 @@ class MergeError:
         self.merge_to = merge_to
         self.error = error
         self.conflict = conflict
+        self.timed_out = isinstance(error, utils.CommandTimeout)
         self.emails = emails or []
 
     def __json__(self):
         return_val = {}
         return_val["merge_from"] = self.merge_from
         return_val["merge_to"] = self.merge_to
-        if self.error:
-            return_val["error"] = self.error.output
+        return_val["error"] = None
+        if isinstance(self.error, CalledProcessError):
+            return_val["error"] = {
+                "returncode": self.error.returncode,
+                "cmd": self.error.cmd,
+                # the whole output is in the command log; the report keeps its tail
+                "output": utils.excerpt(self.error.output or "", utils.DEFAULT_MAX_LINES),
+                "stderr": self.error.stderr,
+            }
         return_val["conflict"] = self.conflict
+        return_val["timed_out"] = self.timed_out
         return_val["emails"] = self.emails
         return return_val
 
@@ -134,6 +169,9 @@ def get_branch_list_raw():
 
 
 def get_branch_list():
+    shas = refs.remote_branches(get_repo_path())
+    if shas is not None:
+        return list(shas)
     orig_dir = os.getcwd()
     os.chdir(get_repo_path())
     branches_raw = get_branch_list_raw()
@@ -199,6 +237,34 @@ def get_dry_run(click_context=None):
     return click_context.params.get("dry_run")
 
 
+@click.pass_context
+def get_rerere(click_context=None):
+    if click_context is None:
+        return False
+    return click_context.params.get("rerere")
+
+
+@click.pass_context
+def get_rerere_cache(click_context=None):
+    if click_context is None or click_context.params.get("rerere_cache") is None:
+        return os.path.abspath(os.path.join(get_work_dir(), "rr-cache"))
+    return os.path.abspath(click_context.params.get("rerere_cache"))
+
+
+@click.pass_context
+def get_ssh_mux(click_context=None):
+    if click_context is None:
+        return False
+    return click_context.params.get("ssh_mux")
+
+
+@click.pass_context
+def get_lfs(click_context=None):
+    if click_context is None:
+        return False
+    return click_context.params.get("lfs")
+
+
 @click.pass_context
 def get_config_branch(click_context=None):
     if click_context is None:
@@ -206,6 +272,105 @@ def get_config_branch(click_context=None):
     return click_context.params.get("config_branch")
 
 
+@click.pass_context
+def get_profile_out(click_context=None):
+    if click_context is None:
+        return None
+    return click_context.params.get("profile_out")
+
+
+@click.pass_context
+def get_metrics_push_url(click_context=None):
+    if click_context is None:
+        return None
+    return click_context.params.get("metrics_push_url")
+
+
+@click.pass_context
+def get_command_log_dir(click_context=None):
+    if click_context is None:
+        return None
+    return click_context.params.get("command_log_dir")
+
+
+@click.pass_context
+def get_report_edges(click_context=None):
+    if click_context is None:
+        return False
+    return click_context.params.get("report_edges")
+
+
+@click.pass_context
+def get_shard(click_context=None) -> Optional[tuple[int, int]]:
+    if click_context is None or click_context.params.get("shard") is None:
+        return None
+    return sharding.parse_shard(click_context.params.get("shard"))
+
+
+@click.pass_context
+def get_shards(click_context=None):
+    if click_context is None:
+        return None
+    return click_context.params.get("shards")
+
+
+@click.pass_context
+def get_shard_dir(click_context=None):
+    if click_context is None or click_context.params.get("shard_dir") is None:
+        return os.path.abspath(os.path.join(get_work_dir(), "shards"))
+    return os.path.abspath(click_context.params.get("shard_dir"))
+
+
+@click.pass_context
+def get_shard_timeout(click_context=None):
+    if click_context is None or click_context.params.get("shard_timeout") is None:
+        return 3600
+    return click_context.params.get("shard_timeout")
+
+
+@click.pass_context
+def get_timeout(click_context=None, command_class=""):
+    # command_class is fetch, merge, push or submodule; None means no timeout
+    if click_context is None:
+        return None
+    return click_context.params.get(f"{command_class}_timeout")
+
+
+@click.pass_context
+def get_maintenance_every(click_context=None):
+    if click_context is None or click_context.params.get("maintenance_every") is None:
+        return 20
+    return click_context.params.get("maintenance_every")
+
+
+@click.pass_context
+def get_maintenance_max_loose_objects(click_context=None):
+    if click_context is None or click_context.params.get("maintenance_max_loose_objects") is None:
+        return 6700
+    return click_context.params.get("maintenance_max_loose_objects")
+
+
+@click.pass_context
+def get_maintenance_max_packs(click_context=None):
+    if click_context is None or click_context.params.get("maintenance_max_packs") is None:
+        return 50
+    return click_context.params.get("maintenance_max_packs")
+
+
+@click.pass_context
+def get_priorities(click_context=None) -> list[str]:
+    if click_context is None:
+        return []
+    return scheduler.parse_priorities(click_context.params.get("priority"))
+
+
+@click.pass_context
+def get_max_duration(click_context=None):
+    if click_context is None:
+        return None
+    return click_context.params.get("max_duration")
+
+
 @click.pass_context
 def get_use_default_plan(click_context=None):
     if click_context is None:
@@ -213,6 +378,7 @@ def get_use_default_plan(click_context=None):
     return click_context.params.get("use_default_plan")
 
 
+@utils.timed
 def clone():
     work_dir = get_work_dir()
     os.makedirs(work_dir, exist_ok=True)
@@ -220,23 +386,26 @@ def clone():
     os.chdir(work_dir)
     repo = get_repo()
     repo_name = get_repo_name()
+    transport.connect("clone")
     try:
         log.info("Attempting to clone repo = {}", repo)
         log.warning("This may fail if the repo already exists")
         command = f" git clone {repo}"
-        utils.execute_shell(command)
+        utils.execute_shell(command, timeout=get_timeout("fetch"))
     except CalledProcessError as err:
         if "already exists" in err.output:
             log.info("Trying to fetch repo {} instead", repo)
             command = f"cd {repo_name} && git fetch --prune"
-            utils.execute_shell(command)
+            utils.execute_shell(command, timeout=get_timeout("fetch"))
         else:
             raise
     os.chdir(repo_name)
     default_branch = utils.execute_shell(
         "git symbolic-ref refs/remotes/origin/HEAD | sed 's@^refs/remotes/origin/@@'"
     )
-    utils.execute_shell(f"git reset --hard HEAD && git checkout {default_branch} && git pull")
+    command = f"git reset --hard HEAD && git checkout {default_branch} && git pull"
+    utils.execute_shell(command, timeout=get_timeout("fetch"))
+    prune_local_branches(keep=default_branch)
     config_branch = get_config_branch()
     if config_branch is not None:
         log.info("checking out config branch {}", config_branch)
@@ -244,104 +413,486 @@ def clone():
     os.chdir(orig_dir)
 
 
+def configure_lfs():
+    # inherited by every git command (and shard worker) from here on: checkouts and
+    # merges then leave LFS files as pointers instead of downloading the content
+    log.info("LFS mode: skipping smudge, merging LFS pointer files only")
+    os.environ["GIT_LFS_SKIP_SMUDGE"] = "1"
+
+
+def configure_rerere():
+    # git keeps rerere resolutions in .git/rr-cache; pointing that at the cache directory
+    # keeps them across fresh clones and lets a shared or imported cache be used
+    git_dir = utils.execute_shell("git rev-parse --absolute-git-dir")
+    link = os.path.join(git_dir, "rr-cache")
+    if not get_rerere():
+        # git turns rerere on by itself while an rr-cache directory exists
+        if os.path.islink(link):
+            os.remove(link)
+        return
+    cache = get_rerere_cache()
+    os.makedirs(cache, exist_ok=True)
+    if os.path.islink(link):
+        if os.readlink(link) == cache:
+            return
+        os.remove(link)
+    elif os.path.isdir(link):
+        shutil.copytree(link, cache, dirs_exist_ok=True)
+        shutil.rmtree(link)
+    os.symlink(cache, link)
+    log.info("Reusing recorded conflict resolutions from {}", cache)
+
+
+@utils.timed
+def prune_local_branches(keep):
+    # merges run on a detached HEAD, so any other local branch was left by an older
+    # version; the previous run's dry-run results go too
+    refs = f"refs/heads {DRY_RUN_REFS.rstrip('/')}"
+    command = f"git for-each-ref --format='%(refname)' {refs}"
+    stale = [ref for ref in utils.execute_shell(command).split() if ref != f"refs/heads/{keep}"]
+    if not stale:
+        return
+    log.info("Deleting {} stale local refs from the work dir clone", len(stale))
+    command = f"git for-each-ref --format='delete %(refname)' {refs}"
+    command += f" | grep -vxF 'delete refs/heads/{keep}' | git update-ref --stdin"
+    utils.execute_shell(command)
+
+
+@utils.timed
 def git_push(branch, merge_output):
     dry_run = get_dry_run()
     if dry_run:
         log.info(f"dry run: skipping push for {branch}")
+        # keep the result for inspection without growing refs/heads; clone() prunes it
+        utils.execute_shell(f"git update-ref {DRY_RUN_REFS}{branch} HEAD")
         return False
     if "Already up to date" not in merge_output:
-        utils.execute_shell(f"git push origin {branch}")
+        # in LFS mode the merged commits only point at objects the remote already has,
+        # so skip the pre-push hook that would look for them locally and upload them
+        command = "git push --no-verify" if get_lfs() else "git push"
+        transport.connect(f"push {branch}")
+        utils.execute_shell(f"{command} origin HEAD:{branch}", timeout=get_timeout("push"))
     else:
         log.info("Nothing to do: {}", merge_output)
     return True
 
 
-def merge_all(merge_item: MergeItem) -> list[MergeError]:
-    errors = []
+def merge_all(merge_item: MergeItem, schedule: Optional[Scheduler] = None) -> list[MergeError]:
     assert merge_item is not None
-    if merge_item.upstream is not None:
-        errors += merge_branches(merge_item.upstream.branch_name, merge_item.branch_name)
-    for downstream in merge_item.downstream:
-        errors += merge_all(downstream)
+    schedule = schedule or Scheduler()
+    graph = plan_graph.build_graph(merge_item)
+    shard = get_shard()
+    owners = sharding.assign_shards(graph, shard[1]) if shard else {}
+    errors = []
+    deferred = []
+    for branch in schedule.order(graph):
+        if not graph.upstreams[branch] or (shard and owners[branch] != shard[0]):
+            continue
+        if schedule.expired():
+            deferred.append(branch)
+        elif shard:
+            upstreams, wait_errors = wait_for_other_shards(graph, owners, branch)
+            report_errors(wait_errors, graph.groups[branch])
+            errors += wait_errors
+            errors += merge_upstreams(upstreams, branch, group=graph.groups[branch])
+        else:
+            errors += merge_upstreams(graph.upstreams[branch], branch, group=graph.groups[branch])
+        if shard:
+            sharding.mark_done(get_shard_dir(), branch)
+    report_deferred(graph, deferred)
     return errors
 
 
-def merge_branches(merge_from: str, merge_to: str) -> list[MergeError]:
+def report_deferred(graph, deferred):
+    if not deferred:
+        return
+    log.warning("Out of time; deferred merges into {} branches: {}", len(deferred), deferred)
+    for branch in deferred:
+        for upstream in graph.upstreams[branch]:
+            append_report(
+                {
+                    "event": "deferred",
+                    "merge_from": upstream,
+                    "merge_to": branch,
+                    "group": graph.groups[branch],
+                }
+            )
+
+
+def wait_for_other_shards(graph, owners, branch) -> tuple[list[str], list[MergeError]]:
+    ready, errors = [], []
+    # one deadline for all of the branch's upstreams, not one per upstream
+    deadline = time.monotonic() + get_shard_timeout()
+    for upstream in graph.upstreams[branch]:
+        owner = owners.get(upstream, owners[branch])
+        if owner == owners[branch]:
+            ready.append(upstream)
+        elif sharding.wait_for(get_shard_dir(), upstream, owner, deadline):
+            transport.connect(f"fetch {upstream}")
+            try:
+                utils.execute_shell(f"git fetch origin {upstream}", timeout=get_timeout("fetch"))
+            except utils.CommandTimeout as err:
+                errors.append(MergeError(upstream, branch, err))
+                continue
+            ready.append(upstream)
+        else:
+            log.error("Gave up waiting for another shard to finish {}", upstream)
+            errors.append(MergeError(upstream, branch, error=None))
+    return ready, errors
+
+
+def merge_branches(merge_from: str, merge_to: str, group="") -> list[MergeError]:
+    return merge_upstreams([merge_from], merge_to, group=group)
+
+
+def checkout(branch):
+    # detached at origin/<branch>, so the clone never grows a local branch per merge target
+    command = "git reset --hard HEAD"
+    command += f" && git clean -fdx && git checkout -f --detach origin/{branch}"
+    with utils.span("checkout", category="phase", branch=branch):
+        utils.execute_shell(command, timeout=get_timeout("merge"))
+        command = "git submodule update --init --recursive"
+        utils.execute_shell(command, timeout=get_timeout("submodule"))
+
+
+def remove_index_lock():
+    # a git killed by the watchdog leaves its lock behind, which would fail the next command
+    utils.execute_shell("rm -f .git/index.lock")
+
+
+def merge_upstreams(upstreams: list[str], merge_to: str, group="") -> list[MergeError]:
+    # one checkout per branch; its upstreams are then merged into it one at a time
+    errors = []
+    try:
+        checkout(merge_to)
+    except utils.CommandTimeout as err:
+        log.error("Skipping merges into {}: {}", merge_to, err)
+        remove_index_lock()
+        errors = [MergeError(merge_from, merge_to, err) for merge_from in upstreams]
+        report_errors(errors, group)
+        return errors
+    for merge_from in upstreams:
+        with utils.span("merge_branches", edge=f"{merge_from} -> {merge_to}", group=group) as edge:
+            edge_errors = merge_edge(merge_from, merge_to, edge)
+        report_errors(edge_errors, group)
+        if not edge_errors and (get_report_edges() or edge["outcome"] == "auto_resolved"):
+            append_report({"event": "edge", "merge_from": merge_from, "merge_to": merge_to, **edge})
+        errors += edge_errors
+    return errors
+
+
+def merge_edge(merge_from: str, merge_to: str, edge: dict) -> list[MergeError]:
     errors = []
     log.info("Merging from {} to {}", merge_from, merge_to)
-    command = "git reset --hard HEAD"
-    command += f" && git clean -fdx && git checkout -f {merge_to}"
-    command += f" && git reset --hard origin/{merge_to}"
-    command += " && git submodule update --init --recursive"
-    utils.execute_shell(command)
+    command = f"git merge origin/{merge_from}"
+    if get_rerere():
+        command = f"git -c rerere.enabled=true -c rerere.autoUpdate=true merge origin/{merge_from}"
     try:
-        merge_output = utils.execute_shell(f"git merge origin/{merge_from}")
+        with utils.span("merge", category="phase", edge=edge["edge"]):
+            merge_output = utils.execute_shell(command, timeout=get_timeout("merge"))
+    except utils.CommandTimeout as err:
+        log.error("Merging from {} to {} timed out", merge_from, merge_to)
+        edge["outcome"] = "timeout"
+        errors.append(MergeError(merge_from, merge_to, err))
+        remove_index_lock()
+        utils.execute_shell("git reset --hard HEAD")
     except CalledProcessError as err:
-        log.error(
-            f"Merging failed from {merge_from} to {merge_to} with error: {err.output}",
-        )
-        merge_error = MergeError(merge_from, merge_to, err)
-        if "conflict" in err.output:
-            log.info("Merge conflict detected")
-            merge_error.conflict = True
-            command = f"git log origin/{merge_to}..origin/{merge_from}"
-            command += " --no-merges --pretty=format:'%ae' | sort | uniq"
-            merge_error.emails = utils.execute_shell(command).split("\n")
-        errors.append(merge_error)
+        if get_rerere() and commit_rerere_resolution(err.output):
+            log.info("Conflicts from {} to {} resolved from the rerere cache", merge_from, merge_to)
+            edge["outcome"] = "auto_resolved"
+            errors += push_merge(merge_from, merge_to, err.output, edge)
+        else:
+            errors.append(failed_merge_error(merge_from, merge_to, err, edge))
+            # back out of the failed merge so the branch's other upstreams can still go in
+            utils.execute_shell("git reset --hard HEAD")
     else:
-        git_push(merge_to, merge_output)
+        edge["outcome"] = "noop" if "Already up to date" in merge_output else "merged"
+        errors += push_merge(merge_from, merge_to, merge_output, edge)
     return errors
 
 
+def failed_merge_error(merge_from, merge_to, err, edge) -> MergeError:
+    log.error(
+        "Merging failed from {} to {} with error: {}",
+        merge_from,
+        merge_to,
+        utils.excerpt(err.output),
+    )
+    merge_error = MergeError(merge_from, merge_to, err)
+    edge["outcome"] = "error"
+    if "conflict" in err.output:
+        log.info("Merge conflict detected")
+        merge_error.conflict = True
+        edge["outcome"] = "conflict"
+        command = f"git log origin/{merge_to}..origin/{merge_from}"
+        command += " --no-merges --pretty=format:'%ae' | sort | uniq"
+        merge_error.emails = utils.execute_shell(command).split("\n")
+    return merge_error
+
+
+def commit_rerere_resolution(merge_output) -> bool:
+    # rerere stages the files it has a recorded resolution for; the merge can only be
+    # committed when no conflicted file is left over
+    if "using previous resolution" not in merge_output:
+        return False
+    if utils.execute_shell("git diff --name-only --diff-filter=U"):
+        return False
+    try:
+        utils.execute_shell("git commit --no-edit", timeout=get_timeout("merge"))
+    except CalledProcessError as err:
+        # a hook rejecting the commit leaves the conflict to be reported like any other
+        log.warning("Committing the rerere resolution failed: {}", utils.excerpt(err.output or ""))
+        if isinstance(err, utils.CommandTimeout):
+            remove_index_lock()
+        return False
+    return True
+
+
+def push_merge(merge_from, merge_to, merge_output, edge) -> list[MergeError]:
+    try:
+        git_push(merge_to, merge_output)
+    except utils.CommandTimeout as err:
+        log.error("Pushing {} timed out", merge_to)
+        edge["outcome"] = "timeout"
+        return [MergeError(merge_from, merge_to, err)]
+    return []
+
+
+@click.pass_context
+def coordinate_shards(click_context, count):
+    shard_dir = get_shard_dir()
+    sharding.reset_shard_dir(shard_dir)
+    # every shard reads and records resolutions in the coordinator's cache
+    params = dict(click_context.params, shard_dir=shard_dir, rerere_cache=get_rerere_cache())
+    workers = []
+    with utils.span("run"):
+        for index in range(1, count + 1):
+            command = sharding.worker_command(
+                click_context.command, params, index, count, get_work_dir()
+            )
+            log.info("Starting shard {}/{}: {}", index, count, command)
+            workers.append(subprocess.Popen(command))  # noqa: S603
+        exit_codes = sharding.wait_for_workers(shard_dir, workers)
+    start_report()
+    with open(str(report_stream_path), "a", encoding="utf-8") as report_file:
+        sharding.combine_reports(shard_dir, count, report_file)
+    report = read_report_errors()
+    utils.trace_events.extend(sharding.combine_traces(shard_dir, count))
+    write_profile()
+    write_metrics([merge_error_from_json(record) for record in report])
+    # a worker exits 1 when it reported merge errors; any other failure is a crash
+    crashed = [
+        index
+        for index, code in enumerate(exit_codes, 1)
+        if code and not (code == 1 and sharding.reported_errors(shard_dir, index))
+    ]
+    if crashed:
+        raise click.ClickException(f"Shards {crashed} exited abnormally")
+    if report:
+        write_error_report(report)
+        sys.exit(1)
+    log.info("Merge complete")
+
+
+def merge_error_from_json(record) -> MergeError:
+    # the command's output stays in the report; metrics only need the counts
+    merge_error = MergeError(record["merge_from"], record["merge_to"], error=None)
+    merge_error.conflict = record["conflict"]
+    merge_error.timed_out = record["timed_out"]
+    merge_error.emails = record["emails"]
+    return merge_error
+
+
+def output_path(name):
+    shard = get_shard() if click.get_current_context(silent=True) else None
+    if shard:
+        # workers run in the coordinator's directory; it combines what they write here
+        return sharding.output_path(get_shard_dir(), shard[0], name)
+    return os.path.join(REPORTS_DIR, name)
+
+
+def write_profile():
+    profile_out = get_profile_out()
+    if profile_out:
+        utils.write_trace(profile_out)
+
+
+def metric_labels(**labels):
+    pairs = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def build_metrics(merge_errors: list[MergeError], trace_events: list[dict]) -> str:
+    repo = get_repo_name()
+    edges: dict[tuple, int] = {}
+    stages: dict[str, list[float]] = {}
+    run_seconds = 0.0
+    for event in trace_events:
+        seconds = event["dur"] / 1e6
+        if event["name"] == "run":
+            # a coordinator's run spans its shards' runs, which overlap each other
+            run_seconds = max(run_seconds, seconds)
+        elif event["cat"] == "stage":
+            stages.setdefault(event["name"], []).append(seconds)
+        if event["name"] == "merge_branches":
+            args = event["args"]
+            key = (args.get("group", ""), args.get("outcome", "error"))
+            edges[key] = edges.get(key, 0) + 1
+    conflicts = len([error for error in merge_errors if error.conflict])
+    lines = [
+        "# HELP git_auto_merge_run_duration_seconds Wall time of the last merge run",
+        "# TYPE git_auto_merge_run_duration_seconds gauge",
+        f"git_auto_merge_run_duration_seconds{metric_labels(repo=repo)} {run_seconds:.6f}",
+        "# HELP git_auto_merge_edges Merge edges processed, by plan group and outcome",
+        "# TYPE git_auto_merge_edges gauge",
+    ]
+    for (group, outcome), count in sorted(edges.items()):
+        labels = metric_labels(repo=repo, group=group, outcome=outcome)
+        lines.append(f"git_auto_merge_edges{labels} {count}")
+    lines += [
+        "# HELP git_auto_merge_errors Merge errors in the last run",
+        "# TYPE git_auto_merge_errors gauge",
+        f"git_auto_merge_errors{metric_labels(repo=repo)} {len(merge_errors)}",
+        "# HELP git_auto_merge_conflicts Merge conflicts in the last run",
+        "# TYPE git_auto_merge_conflicts gauge",
+        f"git_auto_merge_conflicts{metric_labels(repo=repo)} {conflicts}",
+        "# HELP git_auto_merge_stage_duration_seconds Time spent in each stage (clone, push, ...)",
+        "# TYPE git_auto_merge_stage_duration_seconds summary",
+    ]
+    for stage, durations in sorted(stages.items()):
+        labels = metric_labels(repo=repo, stage=stage)
+        lines.append(f"git_auto_merge_stage_duration_seconds_sum{labels} {sum(durations):.6f}")
+        lines.append(f"git_auto_merge_stage_duration_seconds_count{labels} {len(durations)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(merge_errors: list[MergeError]):
+    metrics = build_metrics(merge_errors, utils.trace_events)
+    metrics_path = output_path("metrics.prom")
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    # the textfile collector may read at any moment, so never expose a partial file
+    with open(f"{metrics_path}.tmp", "w", encoding="utf-8") as file:
+        file.write(metrics)
+    os.replace(f"{metrics_path}.tmp", metrics_path)
+    log.info("Metrics written to {}", metrics_path)
+    push_url = get_metrics_push_url()
+    # the coordinator pushes the combined metrics for its shards
+    if push_url and not get_shard():
+        push_metrics(push_url, metrics)
+
+
+def push_metrics(push_url, metrics):
+    url = f"{push_url.rstrip('/')}/metrics/job/git_auto_merge/repo/{get_repo_name()}"
+    if not url.startswith(("http://", "https://")):
+        raise ValueError(f"Unsupported metrics push url: {push_url}")
+    # scheme checked above
+    import urllib.request  # noqa: PLC0415
+
+    request = urllib.request.Request(url, data=metrics.encode("utf-8"), method="PUT")  # noqa: S310
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:  # noqa: S310
+            log.info("Metrics pushed to {} ({})", url, response.status)
+    except OSError as err:
+        log.warning("Failed to push metrics to {}: {}", url, err)
+
+
+def start_report(path=None):
+    global report_stream_path  # noqa: PLW0603
+    if path is None:
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        path = os.path.join(REPORTS_DIR, "report.jsonl")
+    report_stream_path = os.path.abspath(path)
+    with open(report_stream_path, "w", encoding="utf-8"):
+        pass
+    log.info("Streaming report to {}", report_stream_path)
+
+
+def append_report(record: dict):
+    if report_stream_path is None:
+        return
+    line = json.dumps({"time": time.time(), **record})
+    # reopened per record so every finished edge survives the process being killed
+    with open(report_stream_path, "a", encoding="utf-8") as file:
+        file.write(line + "\n")
+
+
+def report_errors(merge_errors: list[MergeError], group=""):
+    # handle_errors and the shard coordinator read errors back from the stream
+    for merge_error in merge_errors:
+        append_report({"event": "error", "group": group, "merge_error": merge_error.__json__()})
+
+
+def read_report_records() -> list[dict]:
+    assert report_stream_path is not None
+    with open(report_stream_path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def read_report_errors() -> list[dict]:
+    records = read_report_records()
+    return [record["merge_error"] for record in records if record["event"] == "error"]
+
+
 def handle_errors(merge_errors: list[MergeError]):
     if not merge_errors:
         return
-    reports_dir = "reports"
-    reports_path = os.path.join(reports_dir, "errors.json")
+    log.info("Logging error report")
+    for merge_error in merge_errors:
+        log.error(merge_error)
+    if report_stream_path is None:
+        report = [merge_error.__json__() for merge_error in merge_errors]
+    else:
+        report = read_report_errors()
+    write_error_report(report)
+    sys.exit(1)
+
+
+def write_error_report(report: list[dict]):
+    reports_path = output_path("errors.json")
+    reports_dir = os.path.dirname(reports_path)
     if os.path.exists(reports_path):
         os.remove(reports_path)
     assert not os.path.exists(reports_path)
     if not os.path.exists(reports_dir):
         os.mkdir(reports_dir)
-    log.info("Logging error report")
-    for merge_error in merge_errors:
-        log.error(merge_error)
     log.info(f"Writing error report to {reports_path}")
     with open(reports_path, "w", encoding="utf-8") as file:
-        result = str(jsonpickle.encode(merge_errors, unpicklable=False, indent=2))
-        file.write(result)
+        json.dump(report, file, indent=2)
         log.info("Error report written to {}", reports_path)
-    sys.exit(1)
 
 
-def load_config(path=None):
-    config = {}
+def load_config(path=None) -> PlanNode:
     config_file_name = get_config_file_name()
     use_default_plan = get_use_default_plan()
     config_file_in_repo_path = f"{get_repo_path()}/{config_file_name}"
     if path:
-        config = load_config_from_path(path)
+        program = load_config_from_path(path)
     elif os.path.exists(config_file_name) and use_default_plan:
-        config = load_config_from_path(config_file_name)
+        program = load_config_from_path(config_file_name)
     elif os.path.exists(config_file_in_repo_path):
-        config = load_config_from_path(config_file_in_repo_path)
+        program = load_config_from_path(config_file_in_repo_path)
     else:
         msg = f"No config file found at {config_file_in_repo_path} \
                 and --use-default-plan was not specified."
         raise ValueError(msg)
-    return config
+    return program
 
 
-def load_config_from_path(path):
+def load_local_config() -> Optional[PlanNode]:
+    # a config that doesn't live in the repo can be checked before cloning it
+    if get_use_default_plan() and os.path.exists(get_config_file_name()):
+        return load_config()
+    return None
+
+
+def load_config_from_path(path) -> PlanNode:
     log.info("Loading config from path {}", path)
     with open(path, encoding="utf-8") as file:
         config = json.load(file)
-    return config
-
-
-def process_regex_selector_config(regex, branch_list):
-    selected_branches = [branch for branch in branch_list if re.search(regex, branch)]
-    return selected_branches
+    return plan_config.compile_config(config)
 
 
 def process_versioned_branches(selected_branches, group, upstream: MergeItem):
@@ -366,36 +917,22 @@ def process_branches(selected_branches, group, upstream: MergeItem):
         upstream.add_downstream_branch(branch=branch, group=group)
 
 
-def process_selector_config(selector_config, branch_list):
-    selected_branches = []
-    if "regex" in selector_config:
-        selected_branches += process_regex_selector_config(
-            regex=selector_config["regex"], branch_list=branch_list
-        )
-    elif "name" in selector_config:
-        if selector_config["name"] in branch_list:
-            selected_branches.append(selector_config["name"])
-    return selected_branches
-
-
-def select_branches(branch_list, selectors_config) -> list:
+def select_branches(branch_list, selectors: list[Selector]) -> list:
     selected_branches = []
-    for selector_config in selectors_config:
-        selected_branches += process_selector_config(
-            selector_config=selector_config, branch_list=branch_list
-        )
+    for selector in selectors:
+        selected_branches += selector.select(branch_list)
     return selected_branches
 
 
-def process_selectors_config(
-    selectors_config, branch_list, upstream: MergeItem, group, sort_type=""
+def process_selectors(
+    selectors: list[Selector], branch_list, upstream: MergeItem, group, sort_type=""
 ) -> MergeItem:
-    log.debug("selectors_config = {}, upstream = {}", selectors_config, upstream)
+    log.debug("selectors = {}, upstream = {}", selectors, upstream)
     return_val = upstream or MergeItem(group=group)
     return_val.group = group
-    selected_branches = select_branches(branch_list=branch_list, selectors_config=selectors_config)
+    selected_branches = select_branches(branch_list=branch_list, selectors=selectors)
     if len(selected_branches) == 0:
-        log.warning(f"No branches matched for {selectors_config}")
+        log.warning(f"No branches matched for {selectors}")
     if len(selected_branches) == 1:
         if upstream is not None:
             return_val = upstream.add_downstream_branch(branch=selected_branches[0], group=group)
@@ -410,77 +947,67 @@ def process_selectors_config(
     return return_val
 
 
-def process_branches_config(
-    branches_config, branch_list, upstream: Optional[MergeItem] = None
+def process_downstream_nodes(
+    nodes: list[PlanNode], branch_list, upstream: Optional[MergeItem] = None
 ) -> Optional[MergeItem]:
     merge_item = None
-    for group in branches_config:
-        branch_config = branches_config[group]
-        merge_item = merge_item or process_branch_config(
-            branch_config=branch_config, branch_list=branch_list, upstream=upstream, group=group
+    for node in nodes:
+        merge_item = merge_item or process_plan_node(
+            node=node, branch_list=branch_list, upstream=upstream
         )
     return merge_item
 
 
-def process_downstream_for_each_config(
-    merge_item: MergeItem, group, downstream_for_each_config, branch_list
-):
-    match_on = downstream_for_each_config.get("matchOn")
-    selector_config = downstream_for_each_config.get("matchedSelectors")
-    matching_branches = select_branches(branch_list=branch_list, selectors_config=selector_config)
+def branch_versions(branches) -> dict[str, str]:
+    versions = {}
+    for branch in branches:
+        try:
+            versions[branch] = VersionedBranch(branch).version
+        except AssertionError:
+            log.warning(f"Skipping branch with bad version: {branch}")
+    return versions
+
+
+def process_downstream_for_each(merge_item: MergeItem, group, rule: ForEachRule, branch_list):
+    matching_branches = select_branches(branch_list=branch_list, selectors=rule.selectors)
+    versions = branch_versions(matching_branches) if rule.match_on == "version" else {}
     merge_items_in_group = get_merge_items_in_group(merge_item, merge_item.group)
     for item in merge_items_in_group:
         for branch in matching_branches:
-            if match_on == "version":
-                try:
-                    versioned_branch = VersionedBranch(branch)
-                    if item.version == versioned_branch.version:
-                        item.add_downstream_branch(branch=branch, group=group)
-                except AssertionError:
-                    log.warning(f"Skipping branch with bad version: {branch}")
-            if match_on == "branch":
-                if branch in item.branch_name:
-                    item.add_downstream_branch(branch=branch, group=group)
-
-
-def process_branch_config(branch_config: dict, branch_list, upstream, group) -> MergeItem:
-    selectors_config = branch_config.get("selectors")
-    sort_type: str = str(branch_config.get("sort"))
-    merge_item = process_selectors_config(
-        selectors_config=selectors_config,
+            if rule.match_on == "version" and versions.get(branch) == item.version:
+                item.add_downstream_branch(branch=branch, group=group)
+            if rule.match_on == "branch" and branch in item.branch_name:
+                item.add_downstream_branch(branch=branch, group=group)
+
+
+def process_plan_node(node: PlanNode, branch_list, upstream) -> MergeItem:
+    merge_item = process_selectors(
+        selectors=node.selectors,
         upstream=upstream,
         branch_list=branch_list,
-        sort_type=sort_type,
-        group=group,
+        sort_type=node.sort_type,
+        group=node.group,
     )
-    downstream_for_each_config = branch_config.get("downstreamForEach")
-    if downstream_for_each_config:
-        process_downstream_for_each_config(
+    if node.for_each:
+        process_downstream_for_each(
             merge_item=merge_item,
-            group=group,
-            downstream_for_each_config=downstream_for_each_config,
+            group=node.group,
+            rule=node.for_each,
             branch_list=branch_list,
         )
-    downstream_branches_config = branch_config.get("downstream", {})
-    process_branches_config(
-        branches_config=downstream_branches_config, upstream=merge_item, branch_list=branch_list
-    )
+    process_downstream_nodes(nodes=node.downstream, upstream=merge_item, branch_list=branch_list)
     return merge_item
 
 
-def build_plan(config) -> Optional[MergeItem]:
+@utils.timed
+def build_plan(program: PlanNode) -> Optional[MergeItem]:
     branch_list = get_branch_list()
-    plan_config = config["plan"]
-    if not plan_config:
-        raise ValueError("No plan found in config")
-    root_config = plan_config["root"]
-    plan = process_branch_config(
-        branch_config=root_config, branch_list=branch_list, upstream=None, group="root"
-    )
+    plan = process_plan_node(node=program, branch_list=branch_list, upstream=None)
     return plan
 
 
-@click.command(
+@click.group(
+    invoke_without_command=True,
     context_settings=dict(auto_envvar_prefix="GIT_AUTO_MERGE", max_content_width=500),
     epilog="Check out the docs at https://github.com/clintmod/git-auto-merge for more details",
 )
@@ -533,21 +1060,317 @@ def build_plan(config) -> Optional[MergeItem]:
     show_default=True,
     help="This mode will do everything except git push",
 )
+@click.option(
+    "--ssh-mux/--no-ssh-mux",
+    default=True,
+    show_default=True,
+    help="Share one ssh connection (a ControlMaster socket in <work-dir>/ssh) between all of a "
+    "run's fetches and pushes",
+)
+@click.option(
+    "--lfs",
+    is_flag=True,
+    default=False,
+    help="Git LFS mode: merge pointer files without downloading or re-uploading LFS objects",
+)
+@click.option(
+    "--rerere",
+    is_flag=True,
+    default=False,
+    help="Resolve recurring conflicts with resolutions recorded by git rerere, and push them",
+)
+@click.option(
+    "--rerere-cache",
+    default=None,
+    help="Directory of recorded conflict resolutions (a .git/rr-cache to import or share)  "
+    "[default: <work-dir>/rr-cache]",
+)
+@click.option(
+    "--profile-out",
+    default=None,
+    help="Write a Chrome/Perfetto trace of every stage and shell command to this file",
+)
+@click.option(
+    "--metrics-push-url",
+    default=None,
+    help="Also push the run metrics to this Prometheus pushgateway",
+)
+@click.option(
+    "--command-log-dir",
+    default=None,
+    help="Write the full output of every shell command to a file in this directory",
+)
+@click.option(
+    "--report-edges",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Also record every successfully merged edge in reports/report.jsonl",
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only merge this worker's share of the plan, e.g. 2/4; needs a --shard-dir shared by all",
+)
+@click.option(
+    "--shards",
+    type=int,
+    default=None,
+    help="Coordinator mode: run this many --shard workers, each with its own clone, and combine "
+    "their reports",
+)
+@click.option(
+    "--shard-dir",
+    default=None,
+    help="Directory shared by all shards for progress markers and reports  [default: "
+    "<work-dir>/shards]",
+)
+@click.option(
+    "--shard-timeout",
+    type=int,
+    default=3600,
+    show_default=True,
+    help="Seconds a shard waits for other shards to merge a branch's upstream branches",
+)
+@click.option(
+    "--fetch-timeout",
+    type=float,
+    default=None,
+    help="Kill a clone or fetch that runs longer than this many seconds  [default: no timeout]",
+)
+@click.option(
+    "--merge-timeout",
+    type=float,
+    default=None,
+    help="Kill a checkout or merge that runs longer than this many seconds  [default: no timeout]",
+)
+@click.option(
+    "--push-timeout",
+    type=float,
+    default=None,
+    help="Kill a push that runs longer than this many seconds  [default: no timeout]",
+)
+@click.option(
+    "--submodule-timeout",
+    type=float,
+    default=None,
+    help="Kill a submodule update that runs longer than this many seconds  [default: no timeout]",
+)
+@click.option(
+    "--priority",
+    default=None,
+    help="Merge ready branches in this order of priorities: any of weight, staleness, behind, "
+    "comma separated; shards only use weight  [default: plan order]",
+)
+@click.option(
+    "--max-duration",
+    type=float,
+    default=None,
+    help="Stop starting new merges after this many seconds and report the rest as deferred",
+)
+@click.option(
+    "--maintenance-every",
+    type=int,
+    default=20,
+    show_default=True,
+    help="Repack, prune and write a commit-graph in the work dir clone every this many runs; "
+    "0 turns maintenance off",
+)
+@click.option(
+    "--maintenance-max-loose-objects",
+    type=int,
+    default=6700,
+    show_default=True,
+    help="Run maintenance early once the clone has more loose objects than this",
+)
+@click.option(
+    "--maintenance-max-packs",
+    type=int,
+    default=50,
+    show_default=True,
+    help="Run maintenance early once the clone has more packs than this",
+)
 def cli(**args):
     """
     A tool to automatically merge git branches.
     """
-    cur_dir = os.getcwd()
+    started = time.monotonic()
     configure_logging()
     log.info("args = {}", args)
-    clone()
-    config = load_config()
-    plan = build_plan(config)
-    log.info("Plan: {}", plan)
-    os.chdir(f"{get_repo_path()}")
-    errors = []
-    if plan:
-        errors = merge_all(plan)
-    os.chdir(cur_dir)
+    if click.get_current_context().invoked_subcommand is not None:
+        return
+    start_run()
+    if get_shards():
+        coordinate_shards(get_shards())
+        return
+    errors = merge_repo(started=started)
     handle_errors(errors)
     log.info("Merge complete")
+
+
+@cli.command("status")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["table", "json"]),
+    default="table",
+    show_default=True,
+    help="Print the status as a table or as JSON",
+)
+@click.pass_context
+def show_status(click_context, output_format):
+    """
+    Shows how far each branch in the plan is behind and ahead of its upstream.
+    """
+    # the merge options (--repo, --work-dir, ...) belong to the parent command
+    with click_context.parent:
+        # the clone and fetches run like a merge's: same command logs, LFS mode and ssh mux
+        start_run()
+        if get_ssh_mux():
+            transport.start(get_repo(), os.path.join(get_work_dir(), "ssh"))
+        cur_dir = os.getcwd()
+        try:
+            program = load_local_config()
+            clone()
+            program = program or load_config()
+            plan = build_plan(program)
+            os.chdir(f"{get_repo_path()}")
+            rows = status.edge_status(plan_graph.build_graph(plan)) if plan else []
+        finally:
+            transport.stop()
+            os.chdir(cur_dir)
+    if output_format == "json":
+        click.echo(json.dumps(rows, indent=2))
+    else:
+        click.echo(status.format_table(rows))
+
+
+def start_run():
+    utils.clear_trace()
+    command_log_dir = get_command_log_dir()
+    # commands run in the work dir clone, so a relative directory would follow them there
+    utils.command_log_dir = os.path.abspath(command_log_dir) if command_log_dir else None
+    if get_lfs():
+        configure_lfs()
+
+
+def merge_repo(program: Optional[PlanNode] = None, started=None) -> list[MergeError]:
+    started = time.monotonic() if started is None else started
+    cur_dir = os.getcwd()
+    shard = get_shard()
+    priorities = get_priorities()
+    if shard:
+        priorities = scheduler.shard_priorities(priorities)
+    start_report(sharding.report_path(get_shard_dir(), shard[0]) if shard else None)
+    if get_ssh_mux():
+        transport.start(get_repo(), os.path.join(get_work_dir(), "ssh"))
+    errors = []
+    try:
+        with utils.span("run"):
+            program = program or load_local_config()
+            clone()
+            program = program or load_config()
+            plan = build_plan(program)
+            log.info("Plan: {}", plan)
+            os.chdir(f"{get_repo_path()}")
+            configure_rerere()
+            maintenance.maintain(
+                get_maintenance_every(),
+                get_maintenance_max_loose_objects(),
+                get_maintenance_max_packs(),
+            )
+            if plan:
+                schedule = Scheduler(
+                    priorities=priorities,
+                    weights=plan_config.group_weights(program),
+                    max_duration=get_max_duration(),
+                    started=started,
+                )
+                errors = merge_all(plan, schedule)
+    finally:
+        transport.stop()
+        os.chdir(cur_dir)
+        write_profile()
+        write_metrics(errors)
+    return errors
+
+
+class RunResult:
+    errors: list[MergeError] = []
+    # one dict per edge: edge, group, outcome and seconds
+    edges: list[dict] = []
+    # seconds spent in each stage, and in the whole "run"
+    timings: dict[str, float] = {}
+
+    def __init__(self, errors, edges, timings):
+        self.errors = errors
+        self.edges = edges
+        self.timings = timings
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def run(repo, config=None, options=None) -> RunResult:
+    """
+    Merges repo like the cli does, but returns the results instead of exiting.
+
+    config is a parsed .git-auto-merge.json; without it the config is found the way
+    the cli finds it. options are cli options by parameter name, for example
+    {"work_dir": "/tmp/merges", "dry_run": True}. Runs change the working directory
+    while they merge, so a process should only run one at a time.
+    """
+    params = {param.name: param.default for param in cli.params}
+    unknown = sorted(set(options or {}) - set(params))
+    if unknown:
+        raise ValueError(f"Unknown options {unknown}")
+    params.update(options or {}, repo=repo)
+    if params["shards"]:
+        raise ValueError("run() merges in this process; run each shard with the shard option")
+    program = plan_config.compile_config(config) if config is not None else None
+    context = click.Context(cli, info_name="git-auto-merge")
+    context.params = params
+    lfs_setting = os.environ.get("GIT_LFS_SKIP_SMUDGE")
+    with context:
+        start_run()
+        try:
+            errors = merge_repo(program)
+        finally:
+            if lfs_setting is None:
+                os.environ.pop("GIT_LFS_SKIP_SMUDGE", None)
+            else:
+                os.environ["GIT_LFS_SKIP_SMUDGE"] = lfs_setting
+    return RunResult(errors, run_edges(), run_timings())
+
+
+def run_edges() -> list[dict]:
+    edges = [
+        {
+            "edge": event["args"]["edge"],
+            "group": event["args"].get("group", ""),
+            "outcome": event["args"].get("outcome", "error"),
+            "seconds": event["dur"] / 1e6,
+        }
+        for event in utils.trace_events
+        if event["name"] == "merge_branches"
+    ]
+    edges += [
+        {
+            "edge": f"{record['merge_from']} -> {record['merge_to']}",
+            "group": record["group"],
+            "outcome": "deferred",
+            "seconds": 0.0,
+        }
+        for record in read_report_records()
+        if record["event"] == "deferred"
+    ]
+    return edges
+
+
+def run_timings() -> dict[str, float]:
+    timings: dict[str, float] = {}
+    for event in utils.trace_events:
+        if event["cat"] == "stage":
+            timings[event["name"]] = timings.get(event["name"], 0.0) + event["dur"] / 1e6
+    return timings
@@ -0,0 +1,97 @@
+"""Keeps the clone cached in --work-dir fast across runs.
+
+Every --maintenance-every runs, or sooner once loose objects or packs pile up
+past their limits, the clone is repacked incrementally, pruned and gets a
+commit-graph with Bloom filters. An ancestry query is timed before and after
+so the effect shows up in the log and the profile. Maintenance is only an
+optimisation: when a task fails the run merges anyway, and maintenance is
+tried again on the next run.
+"""
+
+import json
+import os
+import time
+from subprocess import CalledProcessError
+
+import utils
+from utils import log
+
+STATE_FILE = "git-auto-merge-maintenance.json"
+# walks the whole history, the work that merges and merge-base lookups repeat
+PROBE = "git rev-list --count --all"
+TASKS = (
+    "git repack -d --geometric=2",
+    "git prune --expire=2.weeks.ago",
+    "git commit-graph write --reachable --changed-paths --split",
+)
+
+
+def object_counts() -> dict[str, int]:
+    counts = {}
+    for line in utils.execute_shell("git count-objects -v").splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            counts[key] = int(value)
+    return counts
+
+
+def load_runs(path) -> int:
+    try:
+        with open(path, encoding="utf-8") as file:
+            return int(json.load(file)["runs"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def save_runs(path, runs):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"runs": runs}, file)
+
+
+def due(runs, every, counts, max_loose_objects, max_packs) -> str:
+    if runs >= every:
+        return f"{runs} runs since the last maintenance"
+    if counts.get("count", 0) > max_loose_objects:
+        return f"{counts['count']} loose objects"
+    if counts.get("packs", 0) > max_packs:
+        return f"{counts['packs']} packs"
+    return ""
+
+
+def probe() -> float:
+    start = time.perf_counter()
+    utils.execute_shell(PROBE)
+    return time.perf_counter() - start
+
+
+def maintain(every, max_loose_objects, max_packs) -> bool:
+    # every=0 turns maintenance off
+    if not every:
+        return False
+    path = os.path.join(utils.execute_shell("git rev-parse --absolute-git-dir"), STATE_FILE)
+    runs = load_runs(path) + 1
+    reason = due(runs, every, object_counts(), max_loose_objects, max_packs)
+    if not reason:
+        save_runs(path, runs)
+        return False
+    log.info("Running maintenance on the work dir clone: {}", reason)
+    with utils.span("maintenance", reason=reason) as stats:
+        try:
+            stats["before_seconds"] = probe()
+            for task in TASKS:
+                utils.execute_shell(task)
+            stats["after_seconds"] = probe()
+        except CalledProcessError as err:
+            # e.g. an option the host's git doesn't have, or a lock left by another gc
+            stats["failed"] = err.cmd
+            log.warning("Maintenance failed, merging without it: {}", utils.excerpt(err.output))
+            save_runs(path, runs)
+            return False
+    log.info(
+        "Maintenance done; '{}' took {:.3f}s before and {:.3f}s after",
+        PROBE,
+        stats["before_seconds"],
+        stats["after_seconds"],
+    )
+    save_runs(path, 0)
+    return True
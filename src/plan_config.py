@@ -0,0 +1,166 @@
+"""Validates a .git-auto-merge.json config and compiles it into a plan program.
+
+The checks mirror .git-auto-merge.schema.json so a malformed config fails
+before any clone or fetch, with the path of the offending key in the message.
+The schema isn't installed with the modules, so its keys, required keys and
+types are kept in sync by the tests instead of being read here.
+"""
+
+import re
+from typing import NoReturn, Optional
+
+CONFIG_KEYS = {"version", "repo_path", "plan"}
+CONFIG_VERSION = 1
+NODE_KEYS = {"selectors", "sort", "weight", "downstreamForEach", "downstream"}
+FOR_EACH_KEYS = {"matchOn", "matchedSelectors"}
+SORT_TYPES = {"version"}
+MATCH_ON_TYPES = {"version", "branch"}
+
+
+class Selector:
+    name = ""
+    regex: Optional[re.Pattern] = None
+
+    def __init__(self, name="", regex=None):
+        self.name = name
+        self.regex = regex
+
+    def select(self, branch_list) -> list:
+        if self.regex is not None:
+            return [branch for branch in branch_list if self.regex.search(branch)]
+        if self.name in branch_list:
+            return [self.name]
+        return []
+
+    def __repr__(self):
+        if self.regex is not None:
+            return f"{{'regex': {self.regex.pattern!r}}}"
+        return f"{{'name': {self.name!r}}}"
+
+
+class ForEachRule:
+    match_on = ""
+    selectors: list[Selector] = []
+
+    def __init__(self, match_on, selectors):
+        self.match_on = match_on
+        self.selectors = selectors
+
+
+class PlanNode:
+    group = ""
+    selectors: list[Selector] = []
+    sort_type = ""
+    weight = 0
+    for_each: Optional[ForEachRule] = None
+    downstream: list["PlanNode"] = []
+
+    def __init__(  # noqa: PLR0913
+        self, group, selectors, *, sort_type="", weight=0, for_each=None, downstream=None
+    ):
+        self.group = group
+        self.selectors = selectors
+        self.sort_type = sort_type
+        self.weight = weight
+        self.for_each = for_each
+        self.downstream = downstream or []
+
+
+def fail(path, problem) -> NoReturn:
+    raise ValueError(f"Invalid config at {path}: {problem}")
+
+
+def check_object(value, path, allowed, required):
+    if not isinstance(value, dict):
+        fail(path, f"expected an object, got {type(value).__name__}")
+    for key in required:
+        if key not in value:
+            fail(path, f"missing required key '{key}'")
+    unknown = sorted(set(value) - allowed)
+    if unknown:
+        fail(path, f"unknown keys {unknown}")
+
+
+def check_choice(value, path, choices):
+    if value not in choices:
+        fail(path, f"expected one of {sorted(choices)}, got {value!r}")
+
+
+def compile_selector(selector_config, path) -> Selector:
+    if not isinstance(selector_config, dict) or len(selector_config) != 1:
+        fail(path, "a selector has exactly one of 'name' or 'regex'")
+    [(kind, value)] = selector_config.items()
+    if kind not in ("name", "regex"):
+        fail(path, f"unknown selector '{kind}'")
+    if not isinstance(value, str) or not value:
+        fail(f"{path}.{kind}", "expected a non-empty string")
+    if kind == "name":
+        return Selector(name=value)
+    try:
+        return Selector(regex=re.compile(value))
+    except re.error as err:
+        fail(f"{path}.regex", f"invalid regex: {err}")
+
+
+def compile_selectors(selectors_config, path) -> list[Selector]:
+    if not isinstance(selectors_config, list) or not selectors_config:
+        fail(path, "expected a non-empty list of selectors")
+    return [
+        compile_selector(selector_config, f"{path}[{index}]")
+        for index, selector_config in enumerate(selectors_config)
+    ]
+
+
+def compile_for_each(for_each_config, path) -> ForEachRule:
+    check_object(for_each_config, path, FOR_EACH_KEYS, FOR_EACH_KEYS)
+    check_choice(for_each_config["matchOn"], f"{path}.matchOn", MATCH_ON_TYPES)
+    selectors = compile_selectors(for_each_config["matchedSelectors"], f"{path}.matchedSelectors")
+    return ForEachRule(match_on=for_each_config["matchOn"], selectors=selectors)
+
+
+def compile_node(node_config, group, path) -> PlanNode:
+    check_object(node_config, path, NODE_KEYS, ["selectors"])
+    selectors = compile_selectors(node_config["selectors"], f"{path}.selectors")
+    sort_type = node_config.get("sort", "")
+    if "sort" in node_config:
+        check_choice(sort_type, f"{path}.sort", SORT_TYPES)
+    weight = node_config.get("weight", 0)
+    if isinstance(weight, bool) or not isinstance(weight, int):
+        fail(f"{path}.weight", f"expected an integer, got {weight!r}")
+    for_each = None
+    if "downstreamForEach" in node_config:
+        for_each = compile_for_each(node_config["downstreamForEach"], f"{path}.downstreamForEach")
+    downstream_config = node_config.get("downstream", {})
+    if not isinstance(downstream_config, dict) or (
+        "downstream" in node_config and not downstream_config
+    ):
+        fail(f"{path}.downstream", "expected an object with at least one group")
+    downstream = [
+        compile_node(child_config, child_group, f"{path}.downstream.{child_group}")
+        for child_group, child_config in downstream_config.items()
+    ]
+    return PlanNode(
+        group=group,
+        selectors=selectors,
+        sort_type=sort_type,
+        weight=weight,
+        for_each=for_each,
+        downstream=downstream,
+    )
+
+
+def compile_config(config) -> PlanNode:
+    check_object(config, "$", CONFIG_KEYS, ["plan"])
+    if "version" in config and config["version"] != CONFIG_VERSION:
+        fail("$.version", f"expected {CONFIG_VERSION}, got {config['version']!r}")
+    if "repo_path" in config and not isinstance(config["repo_path"], str):
+        fail("$.repo_path", "expected a string")
+    check_object(config["plan"], "$.plan", {"root"}, ["root"])
+    return compile_node(config["plan"]["root"], "root", "$.plan.root")
+
+
+def group_weights(program: PlanNode) -> dict[str, int]:
+    weights = {program.group: program.weight}
+    for node in program.downstream:
+        weights.update(group_weights(node))
+    return weights
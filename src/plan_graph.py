@@ -0,0 +1,100 @@
+"""Turns the MergeItem tree built from the config into a DAG of branches.
+
+A branch that the tree reaches more than once (matched by several groups, or
+attached under several versions by downstreamForEach) becomes a single node
+with several upstreams, so it is checked out and merged once per run.
+"""
+
+import heapq
+
+from utils import log
+
+
+class PlanGraph:
+    def __init__(self):
+        # branch -> its upstream branches, in the order the plan first listed them
+        self.upstreams: dict[str, list[str]] = {}
+        self.downstreams: dict[str, list[str]] = {}
+        self.groups: dict[str, str] = {}
+        # branch -> index of its first appearance in the plan, used to break ties
+        self.position: dict[str, int] = {}
+
+    def add_branch(self, branch, group):
+        if branch in self.position:
+            return
+        self.position[branch] = len(self.position)
+        self.groups[branch] = group
+        self.upstreams[branch] = []
+        self.downstreams[branch] = []
+
+    def reaches(self, start, target) -> bool:
+        stack = [start]
+        seen = set()
+        while stack:
+            branch = stack.pop()
+            if branch == target:
+                return True
+            if branch not in seen:
+                seen.add(branch)
+                stack += self.downstreams[branch]
+        return False
+
+    def add_edge(self, upstream, downstream) -> bool:
+        if upstream in self.upstreams[downstream]:
+            return False
+        if self.reaches(downstream, upstream):
+            log.warning("Skipping {} -> {}: it would make the plan cyclic", upstream, downstream)
+            return False
+        self.upstreams[downstream].append(upstream)
+        self.downstreams[upstream].append(downstream)
+        return True
+
+    def edges(self) -> list[tuple[str, str]]:
+        return [
+            (upstream, branch)
+            for branch in self.topological_order()
+            for upstream in self.upstreams[branch]
+        ]
+
+    def topological_order(self, priority=None) -> list[str]:
+        # of the branches whose upstreams are all done, the lowest priority(branch) goes next
+        def rank(branch):
+            key = priority(branch) if priority else ()
+            return (key, self.position[branch], branch)
+
+        pending = {branch: len(upstreams) for branch, upstreams in self.upstreams.items()}
+        ready = [rank(branch) for branch, count in pending.items() if not count]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            branch = heapq.heappop(ready)[-1]
+            order.append(branch)
+            for downstream in self.downstreams[branch]:
+                pending[downstream] -= 1
+                if not pending[downstream]:
+                    heapq.heappush(ready, rank(downstream))
+        return order
+
+    def __str__(self):
+        lines = []
+        for branch in self.topological_order():
+            if self.upstreams[branch]:
+                lines.append(f"{', '.join(self.upstreams[branch])} -> {branch}")
+        return "\n".join(lines)
+
+
+def build_graph(merge_item) -> PlanGraph:
+    graph = PlanGraph()
+    appearances = 0
+    stack = [merge_item]
+    while stack:
+        item = stack.pop()
+        appearances += 1
+        graph.add_branch(item.branch_name, item.group)
+        if item.upstream is not None:
+            graph.add_edge(item.upstream.branch_name, item.branch_name)
+        stack += reversed(item.downstream)
+    duplicates = appearances - len(graph.position)
+    if duplicates:
+        log.info("Plan reaches {} branches more than once; each is merged once", duplicates)
+    return graph
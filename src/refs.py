@@ -0,0 +1,113 @@
+"""Reads the clone's remote branches from its ref files instead of starting git.
+
+Branches come from packed-refs (memory-mapped when it is large, and searched
+only around the remote's refs when git wrote it sorted) overlaid with the
+loose files under refs/remotes/<remote>/. Anything this doesn't understand
+(reftable, worktrees, gitdir files, GIT_DIR) returns None so the caller can ask
+git instead.
+"""
+
+import mmap
+import os
+import re
+from typing import Optional
+
+from utils import log
+
+PACKED_REFS_MMAP_BYTES = 1 << 20
+SHA = re.compile(rb"[0-9a-f]{40}|[0-9a-f]{64}")
+
+
+def find_git_dir(path) -> Optional[str]:
+    directory = os.path.abspath(path)
+    if "GIT_DIR" in os.environ or not os.path.isdir(directory):
+        return None
+    while True:
+        dot_git = os.path.join(directory, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.exists(dot_git):
+            # a gitdir file: a submodule or a linked worktree
+            return None
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def parse_packed_refs(data, prefix) -> dict[str, str]:
+    first_line_end = data.find(b"\n")
+    is_sorted = data[:1] == b"#" and b" sorted" in data[:first_line_end]
+    position = 0
+    if is_sorted:
+        # every ref under prefix is in one run of lines; skip straight to it
+        first = data.find(b" " + prefix)
+        if first < 0:
+            return {}
+        position = data.rfind(b"\n", 0, first) + 1
+    refs = {}
+    while position < len(data):
+        end = data.find(b"\n", position)
+        end = len(data) if end < 0 else end
+        line = data[position:end]
+        position = end + 1
+        if not line or line[:1] in (b"#", b"^"):
+            continue
+        sha, _, refname = line.partition(b" ")
+        if refname.startswith(prefix):
+            refs[refname[len(prefix) :].decode("utf-8")] = sha.decode("ascii")
+        elif is_sorted and refs:
+            break
+    return refs
+
+
+def read_packed_refs(git_dir, prefix) -> dict[str, str]:
+    path = os.path.join(git_dir, "packed-refs")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return {}
+        if size < PACKED_REFS_MMAP_BYTES:
+            return parse_packed_refs(file.read(), prefix)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse_packed_refs(data, prefix)
+
+
+def read_loose_refs(git_dir, prefix) -> Optional[dict[str, str]]:
+    root = os.path.join(git_dir, *prefix.decode("utf-8").strip("/").split("/"))
+    refs = {}
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(".lock"):
+                continue
+            path = os.path.join(directory, name)
+            with open(path, "rb") as file:
+                content = file.read().strip()
+            if content.startswith(b"ref: "):
+                # a symbolic ref, like origin/HEAD
+                continue
+            if not SHA.fullmatch(content):
+                return None
+            refs[os.path.relpath(path, root).replace(os.sep, "/")] = content.decode("ascii")
+    return refs
+
+
+def remote_branches(repo_path, remote="origin") -> Optional[dict[str, str]]:
+    git_dir = find_git_dir(repo_path)
+    if git_dir is None:
+        return None
+    if os.path.isdir(os.path.join(git_dir, "reftable")) or os.path.exists(
+        os.path.join(git_dir, "commondir")
+    ):
+        return None
+    prefix = f"refs/remotes/{remote}/".encode()
+    refs = read_packed_refs(git_dir, prefix)
+    loose = read_loose_refs(git_dir, prefix)
+    if loose is None:
+        return None
+    refs.update(loose)
+    log.debug("Read {} {} branches from the ref files in {}", len(refs), remote, git_dir)
+    # the same filter as the `grep -v HEAD` in get_branch_list_raw
+    return {branch: refs[branch] for branch in sorted(refs) if "HEAD" not in branch}
@@ -0,0 +1,96 @@
+"""Orders the plan graph by priority and enforces the --max-duration budget.
+
+Upstreams always merge before their downstreams; among the branches that are
+ready, the priorities pick which goes first:
+
+- weight: the group's "weight" from the config, highest first
+- staleness: how far the branch's last commit trails its newest upstream's
+- behind: how many commits the branch is missing from its upstreams
+
+The plan's own order breaks any remaining ties. Shards wait on each other's
+branches, so they must all merge in the same order: with --shard only the
+weight, which comes from the config, is used.
+"""
+
+import time
+
+import utils
+from utils import log
+
+PRIORITIES = ("weight", "staleness", "behind")
+# read from the local clone, which each shard fetched at a different moment
+CLONE_PRIORITIES = ("staleness", "behind")
+
+
+def parse_priorities(value) -> list[str]:
+    if not value:
+        return []
+    priorities = [priority.strip() for priority in value.split(",")]
+    for priority in priorities:
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}, expected some of {PRIORITIES}")
+    return priorities
+
+
+def shard_priorities(priorities) -> list[str]:
+    ignored = [priority for priority in priorities if priority in CLONE_PRIORITIES]
+    if ignored:
+        log.warning("Ignoring priorities {} with --shard: every shard must use one order", ignored)
+    return [priority for priority in priorities if priority not in CLONE_PRIORITIES]
+
+
+def commit_dates() -> dict[str, int]:
+    command = "git for-each-ref --format='%(refname:lstrip=3) %(committerdate:unix)'"
+    command += " refs/remotes/origin"
+    dates = {}
+    for line in utils.execute_shell(command).splitlines():
+        branch, _, date = line.rpartition(" ")
+        dates[branch] = int(date)
+    return dates
+
+
+def commits_behind(branch, upstreams) -> int:
+    exclude = f"origin/{branch}"
+    include = " ".join(f"origin/{upstream}" for upstream in upstreams)
+    return int(utils.execute_shell(f"git rev-list --count {include} ^{exclude}") or 0)
+
+
+class Scheduler:
+    priorities: list[str] = []
+    weights: dict[str, int] = {}
+    deadline: float | None = None
+
+    def __init__(self, priorities=None, weights=None, max_duration=None, started=None):
+        self.priorities = priorities or []
+        self.weights = weights or {}
+        started = time.monotonic() if started is None else started
+        self.deadline = None if max_duration is None else started + max_duration
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def order(self, graph) -> list[str]:
+        if not self.priorities:
+            return graph.topological_order()
+        dates = commit_dates() if "staleness" in self.priorities else {}
+
+        def staleness(branch):
+            upstream_dates = [dates.get(upstream, 0) for upstream in graph.upstreams[branch]]
+            newest = max(upstream_dates, default=0)
+            return newest - dates.get(branch, newest)
+
+        def priority(branch):
+            key = []
+            for name in self.priorities:
+                if name == "weight":
+                    key.append(-self.weights.get(graph.groups[branch], 0))
+                elif name == "staleness":
+                    key.append(-staleness(branch))
+                else:
+                    upstreams = graph.upstreams[branch]
+                    key.append(-commits_behind(branch, upstreams) if upstreams else 0)
+            return tuple(key)
+
+        order = graph.topological_order(priority)
+        log.info("Merge order by {}: {}", ",".join(self.priorities), order)
+        return order
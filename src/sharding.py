@@ -0,0 +1,169 @@
+"""Splits a plan graph across workers that each run with their own clone.
+
+Every branch with upstreams belongs to a unit: a chain of branches that
+follow each other one to one in the plan. Units are assigned to shards by a
+hash of the unit's first branch, so the assignment doesn't depend on the order
+each worker happened to list its branches in. A worker that needs an upstream
+owned by another shard waits for that shard's done marker in the shared shard
+directory, then fetches the upstream before merging it. The coordinator marks
+a shard that exited with an error as failed, and nothing waits on it after
+that. Workers run in the
+coordinator's directory, so each keeps its trace, metrics and error report in
+its own directory under the shard directory for the coordinator to combine.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+import zlib
+from urllib.parse import quote
+
+from utils import log
+
+POLL_SECONDS = 1.0
+
+
+def parse_shard(value) -> tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError as err:
+        raise ValueError(f"Expected a shard like 1/4, got {value!r}") from err
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def unit_heads(graph) -> dict[str, str]:
+    heads = {}
+    for branch in graph.topological_order():
+        upstreams = graph.upstreams[branch]
+        if not upstreams:
+            continue
+        upstream = upstreams[0]
+        only_child = len(upstreams) == 1 and len(graph.downstreams[upstream]) == 1
+        heads[branch] = heads[upstream] if only_child and upstream in heads else branch
+    return heads
+
+
+def assign_shards(graph, count) -> dict[str, int]:
+    return {
+        branch: zlib.crc32(head.encode("utf-8")) % count + 1
+        for branch, head in unit_heads(graph).items()
+    }
+
+
+def marker_path(shard_dir, branch):
+    return os.path.join(shard_dir, "done", quote(branch, safe=""))
+
+
+def mark_done(shard_dir, branch):
+    os.makedirs(os.path.join(shard_dir, "done"), exist_ok=True)
+    with open(marker_path(shard_dir, branch), "w", encoding="utf-8"):
+        pass
+
+
+def failed_path(shard_dir, index):
+    return os.path.join(shard_dir, "failed", f"shard-{index}")
+
+
+def mark_failed(shard_dir, index):
+    os.makedirs(os.path.join(shard_dir, "failed"), exist_ok=True)
+    with open(failed_path(shard_dir, index), "w", encoding="utf-8"):
+        pass
+
+
+def wait_for(shard_dir, branch, owner, deadline) -> bool:
+    # deadline is a time.monotonic() value
+    path = marker_path(shard_dir, branch)
+    log.info("Waiting for shard {} to finish {}", owner, branch)
+    while not os.path.exists(path):
+        if os.path.exists(failed_path(shard_dir, owner)):
+            log.error("Shard {} failed before finishing {}", owner, branch)
+            return False
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_SECONDS)
+    return True
+
+
+def wait_for_workers(shard_dir, workers) -> list[int]:
+    # a shard that failed won't mark the rest of its branches done; marking it failed
+    # as soon as it exits stops the shards still waiting on them
+    exit_codes: list[int | None] = [None] * len(workers)
+    while None in exit_codes:
+        for index, worker in enumerate(workers, 1):
+            if exit_codes[index - 1] is not None:
+                continue
+            exit_codes[index - 1] = code = worker.poll()
+            if code:
+                mark_failed(shard_dir, index)
+        if None in exit_codes:
+            time.sleep(POLL_SECONDS)
+    return exit_codes
+
+
+def report_path(shard_dir, index):
+    return os.path.abspath(os.path.join(shard_dir, f"report-{index}.jsonl"))
+
+
+def output_path(shard_dir, index, name):
+    return os.path.abspath(os.path.join(shard_dir, f"shard-{index}", name))
+
+
+def reset_shard_dir(shard_dir):
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
+
+
+def worker_command(command, params, index, count, work_dir) -> list[str]:
+    args = []
+    for param in command.params:
+        value = params.get(param.name)
+        if param.name in ("shards", "work_dir", "shard", "profile_out") or value is None:
+            continue
+        if param.name == "command_log_dir":
+            # every worker numbers its commands from 1
+            value = os.path.join(value, f"shard-{index}")
+        if value is False:
+            # pass along a flag that is on by default, like --no-ssh-mux
+            args += param.secondary_opts[-1:]
+            continue
+        option = param.opts[-1]
+        args += [option] if value is True else [option, str(value)]
+    args += ["--work-dir", os.path.join(work_dir, f"shard-{index}"), "--shard", f"{index}/{count}"]
+    # always traced: the coordinator builds the run's profile and metrics from the traces
+    args += ["--profile-out", output_path(params["shard_dir"], index, "trace.json")]
+    code = "import git_auto_merge; git_auto_merge.cli(prog_name='git-auto-merge')"
+    return [sys.executable, "-c", code, *args]
+
+
+def reported_errors(shard_dir, index) -> bool:
+    path = report_path(shard_dir, index)
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf-8") as shard_report:
+        return any('"event": "error"' in line for line in shard_report)
+
+
+def combine_reports(shard_dir, count, report_file):
+    for index in range(1, count + 1):
+        path = report_path(shard_dir, index)
+        if not os.path.exists(path):
+            log.warning("Shard {} wrote no report", index)
+            continue
+        with open(path, encoding="utf-8") as shard_report:
+            report_file.write(shard_report.read())
+
+
+def combine_traces(shard_dir, count) -> list[dict]:
+    events = []
+    for index in range(1, count + 1):
+        path = output_path(shard_dir, index, "trace.json")
+        if not os.path.exists(path):
+            log.warning("Shard {} wrote no trace", index)
+            continue
+        with open(path, encoding="utf-8") as trace:
+            events += json.load(trace)["traceEvents"]
+    return events
@@ -0,0 +1,158 @@
+"""Reports how far each downstream branch in the plan is behind and ahead of its upstream.
+
+With git 2.41 or later the counts for every edge come from one for-each-ref
+call, with an %(ahead-behind:...) atom per upstream, computed in a single walk
+of the commit graph. Older git lists origin's commits and their parents with
+one rev-list instead, and the counts are walked from that in Python, the same
+way git does it: both tips are painted down in generation order until only
+commits reachable from both are left.
+"""
+
+import heapq
+import os
+import re
+from datetime import datetime, timezone
+
+import refs
+import utils
+from scheduler import commit_dates
+
+AHEAD_BEHIND_VERSION = (2, 41)
+# naming every planned ref would overflow the argument limit on big plans
+MAX_PATTERNS_LENGTH = 32 * 1024
+UPSTREAM, DOWNSTREAM, BOTH = 1, 2, 3
+COLUMNS = ("upstream", "downstream", "group", "behind", "ahead", "upstream_date", "downstream_date")
+
+
+def git_version() -> tuple[int, ...]:
+    match = re.search(r"(\d+)\.(\d+)", utils.execute_shell("git version"))
+    return tuple(int(part) for part in match.groups()) if match else (0, 0)
+
+
+def ref_patterns(branches) -> str:
+    # for-each-ref matches a pattern up to a slash, so one pattern per top-level name
+    # covers every planned branch under it
+    names = sorted({branch.split("/")[0] for branch in branches})
+    patterns = " ".join(f"refs/remotes/origin/{name}" for name in names)
+    return patterns if len(patterns) <= MAX_PATTERNS_LENGTH else "refs/remotes/origin"
+
+
+def ahead_behind(edges) -> dict[tuple[str, str], tuple[int, int]]:
+    # (upstream, downstream) -> (behind, ahead) of the downstream
+    upstreams = sorted({upstream for upstream, _ in edges})
+    column = {upstream: index for index, upstream in enumerate(upstreams)}
+    downstreams = {downstream for _, downstream in edges}
+    output_format = "%(refname:lstrip=3)"
+    output_format += "".join(f" %(ahead-behind:origin/{upstream})" for upstream in upstreams)
+    command = f"git for-each-ref --format='{output_format}' {ref_patterns(downstreams)}"
+    counts = {}
+    for line in utils.execute_shell(command).splitlines():
+        branch, *numbers = line.split(" ")
+        if branch in downstreams:
+            counts[branch] = numbers
+    result = {}
+    for upstream, downstream in edges:
+        numbers = counts[downstream]
+        ahead, behind = numbers[2 * column[upstream]], numbers[2 * column[upstream] + 1]
+        result[upstream, downstream] = (int(behind), int(ahead))
+    return result
+
+
+def remote_heads(branches) -> dict[str, str]:
+    heads = refs.remote_branches(os.getcwd())
+    if heads is not None:
+        return heads
+    command = "git for-each-ref --format='%(refname:lstrip=3) %(objectname)'"
+    command += f" {ref_patterns(branches)}"
+    lines = utils.execute_shell(command).splitlines()
+    return dict(line.split(" ") for line in lines)
+
+
+def commit_graph() -> tuple[dict[str, list[str]], dict[str, int]]:
+    # --topo-order lists every commit before its parents
+    command = "git rev-list --parents --topo-order --remotes=origin"
+    lines = utils.execute_shell(command).splitlines()
+    parents, generations = {}, {}
+    for line in reversed(lines):
+        commit, *commit_parents = line.split(" ")
+        parents[commit] = commit_parents
+        # parents missing from a shallow clone count as roots
+        generations[commit] = 1 + max(
+            (generations.get(parent, 0) for parent in commit_parents), default=0
+        )
+    return parents, generations
+
+
+def walk_counts(parents, generations, upstream, downstream) -> tuple[int, int]:
+    flags = {upstream: UPSTREAM}
+    flags[downstream] = flags.get(downstream, 0) | DOWNSTREAM
+    queue = [(-generations.get(commit, 0), commit) for commit in flags]
+    heapq.heapify(queue)
+    # queued commits that only one tip reaches; once none are left, nothing else counts
+    pending = sum(flag != BOTH for flag in flags.values())
+    behind = ahead = 0
+    while pending:
+        _, commit = heapq.heappop(queue)
+        flag = flags[commit]
+        if flag != BOTH:
+            pending -= 1
+            behind += flag == UPSTREAM
+            ahead += flag == DOWNSTREAM
+        for parent in parents.get(commit, []):
+            # a parent has a lower generation, so it hasn't been walked yet
+            if parent not in flags:
+                flags[parent] = flag
+                heapq.heappush(queue, (-generations.get(parent, 0), parent))
+                pending += flag != BOTH
+            elif flags[parent] | flag == BOTH and flags[parent] != BOTH:
+                flags[parent] = BOTH
+                pending -= 1
+    return behind, ahead
+
+
+def walked_counts(edges) -> dict[tuple[str, str], tuple[int, int]]:
+    heads = remote_heads({branch for edge in edges for branch in edge})
+    parents, generations = commit_graph()
+    return {
+        (upstream, downstream): walk_counts(
+            parents, generations, heads[upstream], heads[downstream]
+        )
+        for upstream, downstream in edges
+    }
+
+
+def iso_date(timestamp) -> str:
+    if timestamp is None:
+        return ""
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def edge_status(graph) -> list[dict]:
+    edges = graph.edges()
+    if not edges:
+        return []
+    if git_version() >= AHEAD_BEHIND_VERSION:
+        counts = ahead_behind(edges)
+    else:
+        counts = walked_counts(edges)
+    dates = commit_dates()
+    return [
+        {
+            "upstream": upstream,
+            "downstream": downstream,
+            "group": graph.groups[downstream],
+            "behind": counts[upstream, downstream][0],
+            "ahead": counts[upstream, downstream][1],
+            "upstream_date": iso_date(dates.get(upstream)),
+            "downstream_date": iso_date(dates.get(downstream)),
+        }
+        for upstream, downstream in edges
+    ]
+
+
+def format_table(rows) -> str:
+    cells = [list(COLUMNS)] + [[str(row[column]) for column in COLUMNS] for row in rows]
+    widths = [max(len(line[index]) for line in cells) for index in range(len(COLUMNS))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in cells
+    )
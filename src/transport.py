@@ -0,0 +1,135 @@
+"""Shares one SSH connection per remote host across a run's git operations.
+
+For an ssh repo URL, GIT_SSH_COMMAND is pointed at an OpenSSH ControlMaster
+socket, so the clone, fetches, pushes, submodule and LFS traffic all ride the
+same connection instead of each paying for a handshake. Before every remote
+operation the master is checked (and opened if it isn't up), and the time that
+took is logged. git's own ssh only ever uses an open master: when none could be
+opened it connects directly rather than becoming a master itself.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from subprocess import DEVNULL
+from typing import Optional
+from urllib.parse import urlsplit
+
+import utils
+from utils import log
+
+# the master outlives a run that died before stop() by at most this long
+PERSIST_SECONDS = 600
+# sockets live in <dir>/%C (40 characters), and unix socket paths are capped at
+# 104-108 bytes including the random suffix ssh adds while creating one
+MAX_SOCKET_DIR_LENGTH = 48
+SCP_LIKE = re.compile(r"^(?:(?P<user>[^@/:]+)@)?(?P<host>[^@/:]+):(?!//)")
+
+session: Optional["SshMux"] = None
+
+
+def ssh_destination(url) -> Optional[tuple[str, Optional[int]]]:
+    parsed = urlsplit(url)
+    if parsed.scheme in ("ssh", "git+ssh", "ssh+git"):
+        user = f"{parsed.username}@" if parsed.username else ""
+        return f"{user}{parsed.hostname}", parsed.port
+    match = None if "://" in url else SCP_LIKE.match(url)
+    if match is None:
+        return None
+    user = f"{match['user']}@" if match["user"] else ""
+    return f"{user}{match['host']}", None
+
+
+class SshMux:
+    destination = ""
+    port: Optional[int] = None
+    socket_dir = ""
+    owns_socket_dir = False
+    previous_command: Optional[str] = None
+    ssh = "ssh"
+
+    def __init__(self, destination, port, socket_dir):
+        self.destination = destination
+        self.port = port
+        self.owns_socket_dir = len(os.path.abspath(socket_dir)) > MAX_SOCKET_DIR_LENGTH
+        if self.owns_socket_dir:
+            log.info("{} is too long for ssh control sockets; using a temp dir", socket_dir)
+            socket_dir = tempfile.mkdtemp(prefix="gam-ssh-")
+        self.socket_dir = os.path.abspath(socket_dir)
+        self.previous_command = os.environ.get("GIT_SSH_COMMAND")
+        self.ssh = self.previous_command or "ssh"
+
+    def control_path(self) -> str:
+        return f"-o ControlPath='{os.path.join(self.socket_dir, '%C')}'"
+
+    def options(self) -> str:
+        return f"{self.control_path()} -o ControlPersist={PERSIST_SECONDS}"
+
+    def target(self) -> str:
+        port = f"-p {self.port} " if self.port else ""
+        return f"{port}{self.destination}"
+
+    def start(self):
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        # with ControlMaster=auto a git command would become a persisting master when
+        # connect() failed, and the backgrounded master would hold its output open
+        os.environ["GIT_SSH_COMMAND"] = f"{self.ssh} -o ControlMaster=no {self.control_path()}"
+        log.info("Multiplexing ssh connections to {} through {}", self.destination, self.socket_dir)
+
+    def ssh_command(self, args, control_path=None) -> int:
+        # the master forks into the background holding whatever it inherited, so
+        # it must not get a pipe that a caller would wait on
+        options = f"-o ControlPath='{control_path}'" if control_path else self.options()
+        command = f"{self.ssh} {options} {args} {self.target()}"
+        return subprocess.run(  # noqa: S602
+            command, shell=True, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, check=False
+        ).returncode
+
+    def connect(self, operation):
+        start = time.perf_counter()
+        with utils.span("ssh_connect", category="phase", operation=operation) as args:
+            args["reused"] = self.ssh_command("-O check") == 0
+            if not args["reused"] and self.ssh_command("-o BatchMode=yes -M -N -f"):
+                log.warning("Could not open an ssh master connection; git will connect itself")
+        log.info(
+            "ssh connection for {}: {} in {:.3f}s",
+            operation,
+            "reused" if args["reused"] else "opened",
+            time.perf_counter() - start,
+        )
+
+    def stop(self):
+        # one socket per master; a run that was killed may have left a stale one behind
+        for name in os.listdir(self.socket_dir):
+            self.ssh_command("-O exit", control_path=os.path.join(self.socket_dir, name))
+        if self.previous_command is None:
+            os.environ.pop("GIT_SSH_COMMAND", None)
+        else:
+            os.environ["GIT_SSH_COMMAND"] = self.previous_command
+        if self.owns_socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def start(url, socket_dir) -> Optional[SshMux]:
+    global session  # noqa: PLW0603
+    destination = ssh_destination(url)
+    if destination is None:
+        return None
+    session = SshMux(*destination, socket_dir)
+    session.start()
+    return session
+
+
+def connect(operation):
+    if session is not None:
+        session.connect(operation)
+
+
+def stop():
+    global session  # noqa: PLW0603
+    if session is not None:
+        session.stop()
+        session = None
@@ -1,33 +1,196 @@
-from subprocess import PIPE, STDOUT, CalledProcessError, run
+import functools
+import itertools
+import json
+import os
+import re
+import signal
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext, suppress
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen
 
-from loguru import logger as log
 
+class LazyLogger:
+    """Stands in for loguru's logger, importing it on first use to keep startup fast."""
 
-def execute_shell(command, is_shell=True, cwd=".", suppress_errors=False):
+    def __getattr__(self, name):
+        from loguru import logger  # noqa: PLC0415
+
+        return getattr(logger, name)
+
+
+log = LazyLogger()
+
+# command output is streamed and returned whole; reports keep only its last
+# DEFAULT_MAX_LINES lines, and callers can pass max_lines to bound it while streaming
+DEFAULT_MAX_LINES = 500
+LOG_EXCERPT_LINES = 20
+
+# completed spans in Chrome trace event format (https://ui.perfetto.dev reads these)
+trace_events: list[dict] = []
+
+# when set, the full output of every command is written to a file in this directory
+command_log_dir: str | None = None
+command_counter = itertools.count(1)
+
+
+class CommandTimeout(CalledProcessError):
+    """Raised when the watchdog killed a command that ran longer than its timeout."""
+
+    timeout: float = 0
+
+    def __init__(self, cmd, timeout, output=None):
+        super().__init__(-signal.SIGKILL, cmd, output=output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"Command '{self.cmd}' timed out after {self.timeout} seconds"
+
+
+@contextmanager
+def span(name, category="stage", **args):
+    start = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        duration = time.perf_counter_ns() - start
+        trace_events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start // 1000,
+                "dur": duration // 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+        log.debug("{} {} took {:.3f}s", category, name, duration / 1e9)
+
+
+def timed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def clear_trace():
+    trace_events.clear()
+
+
+def write_trace(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+    log.info("Profile written to {}", path)
+
+
+def excerpt(output, max_lines=LOG_EXCERPT_LINES):
+    lines = output.split("\n")
+    if len(lines) <= max_lines:
+        return output
+    return f"[... {len(lines) - max_lines} lines omitted ...]\n" + "\n".join(lines[-max_lines:])
+
+
+def open_command_log(command):
+    if not command_log_dir:
+        return nullcontext()
+    os.makedirs(command_log_dir, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", str(command)).strip("-")[:60]
+    path = os.path.join(command_log_dir, f"{next(command_counter):04d}-{slug}.log")
+    log.debug("full output of command goes to {}", path)
+    return open(path, "w", encoding="utf-8")
+
+
+def stream_output(stream, max_lines, log_file=None):
+    tail = deque(maxlen=max_lines)
+    total = 0
+    for line in stream:
+        total += 1
+        tail.append(line)
+        if log_file:
+            log_file.write(line)
+    return "".join(tail), total - len(tail)
+
+
+@contextmanager
+def watchdog(proc, timeout):
+    # the command runs in its own session, so killing the group also stops the
+    # ssh, credential helper or hook processes git started
+    timed_out = threading.Event()
+    if timeout is None:
+        yield timed_out
+        return
+
+    def kill():
+        timed_out.set()
+        log.error("command timed out after {}s, killing process group {}", timeout, proc.pid)
+        with suppress(ProcessLookupError):
+            os.killpg(proc.pid, signal.SIGKILL)
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield timed_out
+    finally:
+        timer.cancel()
+
+
+def execute_shell(  # noqa: PLR0913
+    command,
+    is_shell=True,
+    cwd=".",
+    suppress_errors=False,
+    max_lines=None,
+    *,
+    timeout=None,
+):
     output = ""
     log.debug("--- executing shell command ---")
     log.debug("setting working dir to: {}", cwd)
-    log.info("command: {}", str(command))
+    log.info("command: {}", command)
     try:
-        # running git shell pipelines is this tool's purpose
-        proc = run(  # noqa: S603
-            command,
-            shell=is_shell,
-            cwd=cwd,
-            stderr=STDOUT,
-            check=True,
-            stdout=PIPE,
-            universal_newlines=True,
-        )
-        log.debug("proc = {}", str(proc))
-        output = proc.stdout.strip()
-        log.info("output = {}", output)
+        with span(str(command), category="shell", cwd=cwd), open_command_log(command) as log_file:
+            # running git shell pipelines is this tool's purpose
+            with (
+                Popen(  # noqa: S603
+                    command,
+                    shell=is_shell,
+                    cwd=cwd,
+                    stderr=STDOUT,
+                    stdout=PIPE,
+                    universal_newlines=True,
+                    start_new_session=timeout is not None,
+                ) as proc,
+                watchdog(proc, timeout) as timed_out,
+            ):
+                tail, omitted = stream_output(proc.stdout, max_lines, log_file)
+        log.opt(lazy=True).debug("proc = {}", lambda: f"{proc.args} -> {proc.returncode}")
+        tail = tail.strip()
+        if omitted:
+            log.warning("output truncated, {} earlier lines omitted", omitted)
+            if proc.returncode:
+                tail = f"[... {omitted} earlier lines omitted ...]\n{tail}"
+        log.opt(lazy=True).info("output = {}", lambda: excerpt(tail))
+        if timed_out.is_set():
+            raise CommandTimeout(command, timeout, output=tail)
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, command, output=tail)
+        output = tail
     except CalledProcessError as err:
         log.error(
             "\nError Info:\nerror code = {}\ncmd {}\nerror message:{}",
             err.returncode,
             err.cmd,
-            err.output,
+            excerpt(err.output or ""),
         )
         if not suppress_errors:
             raise
@@ -32,13 +32,23 @@ def remote_refs():
     return refs
 
 
-def local_branches():
-    out = git(["for-each-ref", "--format=%(refname:short)", "refs/heads"], cwd=REPO_DIR).stdout
+def dry_run_branches():
+    refs = "refs/git-auto-merge/dry-run"
+    out = git(["for-each-ref", "--format=%(refname:lstrip=3)", refs], cwd=REPO_DIR).stdout
     return out.split()
 
 
+def merged_ref(branch):
+    # a dry run keeps each merge result under refs/git-auto-merge/dry-run; branches
+    # that were never merged into (like main) are still at origin's tip
+    if branch in dry_run_branches():
+        return f"refs/git-auto-merge/dry-run/{branch}"
+    return f"refs/remotes/origin/{branch}"
+
+
 def is_ancestor(upstream, downstream):
-    return git(["merge-base", "--is-ancestor", upstream, downstream], cwd=REPO_DIR).returncode == 0
+    ancestor = ["merge-base", "--is-ancestor", merged_ref(upstream), merged_ref(downstream)]
+    return git(ancestor, cwd=REPO_DIR).returncode == 0
 
 
 def test_cli_works(args):
@@ -58,11 +68,11 @@ def test_cli_skips_push_when_dry_run(args):
     assert result.exit_code == 0
     # the merges really happened in the local clone: per the fixture repo's
     # plan (main -> hotfix/release -> develop -> feature/*), every upstream
-    # must now be an ancestor of its downstream; ignore local branches that
-    # a stale workdir may carry but the remote no longer has
+    # must now be an ancestor of its downstream; ignore results that a stale
+    # workdir may carry for branches the remote no longer has
     remote_branches = {ref.removeprefix("refs/heads/") for ref in refs_before}
-    branches = [b for b in local_branches() if b in remote_branches]
-    assert "main" in branches and "develop" in branches
+    branches = [b for b in dry_run_branches() if b in remote_branches]
+    assert "develop" in branches
     assert is_ancestor("main", "develop")
     versioned = [b for b in branches if b.startswith(("release/", "hotfix/"))]
     assert versioned, "fixture repo should select at least one release/hotfix branch"
@@ -71,8 +81,10 @@ def test_cli_skips_push_when_dry_run(args):
         assert is_ancestor(branch, "develop"), f"{branch} not merged into develop"
     for branch in (b for b in branches if b.startswith("feature/")):
         assert is_ancestor("develop", branch), f"develop not merged into {branch}"
-    # and dry run means the remote was left untouched
+    # and dry run means the remote was left untouched, with no local branch per target
     assert remote_refs() == refs_before
+    heads = git(["for-each-ref", "--format=%(refname)", "refs/heads"], cwd=REPO_DIR).stdout
+    assert not {f"refs/heads/{b}" for b in branches} & set(heads.split())
 
 
 def test_cli_logs_everything_when_debug(args):
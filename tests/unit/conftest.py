@@ -0,0 +1,39 @@
+import subprocess
+
+import pytest
+
+
+def git(args, cwd):
+    return subprocess.run(
+        ["git", *args], cwd=cwd, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+@pytest.fixture(name="git_identity")
+def set_git_identity(monkeypatch):
+    for var in ("GIT_AUTHOR", "GIT_COMMITTER"):
+        monkeypatch.setenv(f"{var}_NAME", "test")
+        monkeypatch.setenv(f"{var}_EMAIL", "test@example.com")
+
+
+def seed_initial_commit(seed):
+    git(["commit", "--allow-empty", "-m", "initial"], cwd=seed)
+
+
+@pytest.fixture(name="seed")
+def create_seed():
+    # override this fixture (or parametrize "seed") with a function that builds
+    # the origin's history in the working clone it's given
+    return seed_initial_commit
+
+
+@pytest.fixture(name="origin")
+def create_origin(tmp_path, git_identity, seed):
+    origin = tmp_path / "origin.git"
+    clone = tmp_path / "seed"
+    git(["init", "--bare", "-b", "main", str(origin)], cwd=tmp_path)
+    git(["clone", str(origin), str(clone)], cwd=tmp_path)
+    seed(clone)
+    git(["push", "origin", "--all"], cwd=clone)
+    git(["push", "origin", "--tags"], cwd=clone)
+    return origin
@@ -1,20 +1,28 @@
 #!/usr/bin/env python
 
+import functools
+import json
 import os
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from subprocess import CalledProcessError
 from unittest.mock import ANY, patch
 
 import click
 import pytest
+from click.testing import CliRunner
 
 import git_auto_merge as gam
+import utils
 
 
 @pytest.fixture(autouse=True)
 def mock_os_makedirs(mocker):
     mocker.patch("os.makedirs")
     mocker.patch("os.chdir")
+    # branch lists come from the mocked get_branch_list_raw, not a leftover workdir clone
+    mocker.patch("refs.remote_branches", return_value=None)
 
 
 @pytest.fixture(autouse=True, name="click_context")
@@ -104,11 +112,31 @@ def test_merge_all(raw_branches_mock, execute_shell_mock, click_context):
         execute_shell_mock.assert_called()
 
 
-def test_git_push_does_not_push_when_dryrun_is_true():
+@patch("utils.execute_shell")
+def test_git_push_does_not_push_when_dryrun_is_true(execute_shell_mock):
     context = click.Context(click.Command("git-auto-merge"))
     context.params = {"dry_run": True}
     with context:
         assert not gam.git_push("asdf", "asdf")
+    execute_shell_mock.assert_called_once_with(
+        "git update-ref refs/git-auto-merge/dry-run/asdf HEAD"
+    )
+
+
+@patch("utils.execute_shell")
+def test_lfs_mode_pushes_without_the_lfs_upload_hook(execute_shell_mock, click_context):
+    with click_context:
+        gam.git_push("develop", "Merge made by the 'ort' strategy.")
+        assert execute_shell_mock.call_args.args[0] == "git push origin HEAD:develop"
+        click_context.params["lfs"] = True
+        gam.git_push("develop", "Merge made by the 'ort' strategy.")
+        assert execute_shell_mock.call_args.args[0] == "git push --no-verify origin HEAD:develop"
+
+
+def test_configure_lfs_skips_smudge_for_every_git_command(monkeypatch):
+    monkeypatch.setenv("GIT_LFS_SKIP_SMUDGE", "0")
+    gam.configure_lfs()
+    assert utils.execute_shell("echo $GIT_LFS_SKIP_SMUDGE") == "1"
 
 
 @patch("utils.execute_shell")
@@ -138,15 +166,16 @@ def test_merge_problem():
     assert str(mp1)
 
 
-def raise_merge_error(command):
+def raise_merge_error(command, **_kwargs):
     if "git merge" in command:
         raise CalledProcessError(0, command, output="asdf\nasdf")
 
 
 @patch("utils.execute_shell")
-def test_merge_branches_reports_errors(execute_shell_mock):
+def test_merge_branches_reports_errors(execute_shell_mock, click_context):
     execute_shell_mock.side_effect = raise_merge_error
-    errors = gam.merge_branches(merge_from="from", merge_to="to")
+    with click_context:
+        errors = gam.merge_branches(merge_from="from", merge_to="to")
     assert errors
 
 
@@ -328,3 +357,257 @@ def get_weird_branch_bug():
         "      release/electro-24.5.1\n"
         "      release/flash-24.6.0\n"
     )
+
+
+@patch("utils.execute_shell")
+def test_merge_branches_records_phase_spans(execute_shell_mock, click_context):
+    with click_context:
+        gam.utils.clear_trace()
+        gam.merge_branches("develop", "feature/x")
+        spans = [(event["name"], event["cat"]) for event in gam.utils.trace_events]
+        assert ("checkout", "phase") in spans
+        assert ("merge", "phase") in spans
+        assert ("git_push", "stage") in spans
+        assert spans[-1] == ("merge_branches", "stage")
+        assert gam.utils.trace_events[-1]["args"] == {
+            "edge": "develop -> feature/x",
+            "group": "",
+            "outcome": "merged",
+        }
+
+
+def trace_event(name, category, dur, **args):
+    return {"name": name, "cat": category, "ph": "X", "ts": 0, "dur": dur, "args": args}
+
+
+def test_build_metrics(click_context):
+    with click_context:
+        err = CalledProcessError(returncode=1, cmd="git merge", output="conflict")
+        errors = [gam.MergeError("develop", "feature/a", err, conflict=True)]
+        events = [
+            trace_event("clone", "stage", 2_000_000),
+            trace_event("merge_branches", "stage", 1_000, group="feature", outcome="merged"),
+            trace_event("merge_branches", "stage", 1_000, group="feature", outcome="conflict"),
+            trace_event("merge_branches", "stage", 1_000, group="feature", outcome="noop"),
+            trace_event("git push origin develop", "shell", 500_000),
+            trace_event("run", "stage", 3_500_000),
+        ]
+        metrics = gam.build_metrics(errors, events)
+        repo = 'repo="git_auto_merge_test"'
+        assert f"git_auto_merge_run_duration_seconds{{{repo}}} 3.500000" in metrics
+        assert f'git_auto_merge_edges{{{repo},group="feature",outcome="noop"}} 1' in metrics
+        assert f"git_auto_merge_conflicts{{{repo}}} 1" in metrics
+        assert f'git_auto_merge_stage_duration_seconds_sum{{{repo},stage="clone"}} 2.0' in metrics
+        assert 'stage="merge_branches"} 3' in metrics
+        assert "git push" not in metrics
+
+
+def test_write_metrics_pushes_to_pushgateway(mocker, tmp_path, click_context):
+    received = {}
+
+    class PushGateway(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            received["path"] = self.path
+            received["body"] = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), PushGateway)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    mocker.patch("git_auto_merge.REPORTS_DIR", str(tmp_path))
+    with click_context:
+        click_context.params["metrics_push_url"] = f"http://127.0.0.1:{server.server_port}"
+        gam.write_metrics([])
+    thread.join(timeout=10)
+    server.server_close()
+    metrics = (tmp_path / "metrics.prom").read_text(encoding="utf-8")
+    assert "git_auto_merge_errors" in metrics
+    assert received["path"] == "/metrics/job/git_auto_merge/repo/git_auto_merge_test"
+    assert received["body"] == metrics
+
+
+@patch("utils.execute_shell")
+def test_report_is_streamed_and_errors_json_built_from_it(
+    execute_shell_mock, mocker, monkeypatch, tmp_path, click_context
+):
+    monkeypatch.setattr(gam, "report_stream_path", None)
+    mocker.patch("git_auto_merge.REPORTS_DIR", str(tmp_path))
+    mocker.patch("sys.exit")
+    execute_shell_mock.side_effect = raise_merge_error
+    with click_context:
+        click_context.params["report_edges"] = True
+        gam.start_report()
+        errors = gam.merge_branches("main", "develop", group="develop")
+        execute_shell_mock.side_effect = None
+        gam.merge_branches("develop", "feature/a", group="feature")
+        lines = (tmp_path / "report.jsonl").read_text(encoding="utf-8").splitlines()
+        records = [json.loads(line) for line in lines]
+        assert [record["event"] for record in records] == ["error", "edge"]
+        assert records[0]["merge_error"]["error"]["output"] == "asdf\nasdf"
+        assert records[1]["outcome"] == "merged"
+        gam.handle_errors(errors)
+    report = json.loads((tmp_path / "errors.json").read_text(encoding="utf-8"))
+    assert report == [records[0]["merge_error"]]
+    assert report[0]["merge_to"] == "develop"
+
+
+def test_errors_json_matches_the_jsonpickle_report():
+    # errors.json as jsonpickle wrote it before the report was streamed
+    with open("tests/unit/test_files/errors.json", encoding="utf-8") as file:
+        baseline = json.load(file)
+    error = CalledProcessError(
+        1,
+        "git merge origin/main",
+        output="CONFLICT (content): Merge conflict in a.txt\nAutomatic merge failed",
+    )
+    merge_errors = [
+        gam.MergeError("main", "develop", error, conflict=True, emails=["dev@example.com"]),
+        gam.MergeError("develop", "feature/a", None),
+    ]
+    report = [merge_error.__json__() for merge_error in merge_errors]
+    # fields added since then are appended; the original ones are unchanged
+    assert [
+        {key: record[key] for key in expected} for record, expected in zip(report, baseline)
+    ] == baseline
+
+
+def time_out_push(command, **kwargs):
+    if command.startswith("git push"):
+        assert kwargs["timeout"] == 5
+        raise utils.CommandTimeout(command, 5, output="")
+    return ""
+
+
+@patch("utils.execute_shell")
+def test_timed_out_push_is_recorded_and_the_run_continues(execute_shell_mock, click_context):
+    execute_shell_mock.side_effect = time_out_push
+    with click_context:
+        click_context.params["push_timeout"] = 5
+        errors = gam.merge_upstreams(["main", "hotfix/1.0.1"], "develop")
+    assert [error.merge_from for error in errors] == ["main", "hotfix/1.0.1"]
+    assert all(error.timed_out and not error.conflict for error in errors)
+    assert errors[0].__json__()["timed_out"]
+    assert errors[0].__json__()["error"]["returncode"] < 0
+
+
+@pytest.mark.usefixtures("git_identity")
+def test_prune_local_branches_keeps_only_the_default_branch(tmp_path, mocker):
+    # os.chdir is mocked in this module, so run the commands in the test repo instead
+    in_repo = functools.partial(utils.execute_shell, cwd=str(tmp_path))
+    in_repo("git init -q -b main && git commit -q --allow-empty -m init")
+    in_repo("git branch develop && git pack-refs --all && git branch feature/a")
+    in_repo("git update-ref refs/git-auto-merge/dry-run/develop HEAD")
+    mocker.patch("utils.execute_shell", side_effect=in_repo)
+    gam.prune_local_branches(keep="main")
+    refs = in_repo("git for-each-ref --format='%(refname)' refs/heads refs/git-auto-merge")
+    assert refs == "refs/heads/main"
+
+
+def seed_develop_and_feature_conflict(seed):
+    in_seed = functools.partial(utils.execute_shell, cwd=str(seed))
+    in_seed("echo base > a.txt && git add a.txt && git commit -qm base")
+    in_seed("git checkout -qb develop && echo develop > a.txt && git commit -qam develop")
+    in_seed("git checkout -qb feature/x main && echo feature > a.txt && git commit -qam feature")
+
+
+@pytest.mark.parametrize("seed", [seed_develop_and_feature_conflict])
+def test_rerere_resolves_a_recorded_conflict_and_pushes(
+    origin, tmp_path, mocker, monkeypatch, click_context
+):
+    in_tmp = functools.partial(utils.execute_shell, cwd=str(tmp_path))
+    in_tmp(f"git clone -q {origin} work")
+    in_work = functools.partial(utils.execute_shell, cwd=str(tmp_path / "work"))
+    mocker.patch("utils.execute_shell", side_effect=in_work)
+    monkeypatch.setattr(gam, "report_stream_path", str(tmp_path / "report.jsonl"))
+    (tmp_path / "rr-cache").mkdir()
+    with click_context:
+        click_context.params.update(rerere=True, rerere_cache=str(tmp_path / "rr-cache"))
+        gam.configure_rerere()
+        # someone resolves the conflict once; rerere records the resolution in the cache
+        in_work("git checkout -q --detach origin/feature/x", suppress_errors=True)
+        in_work("git -c rerere.enabled=true merge origin/develop", suppress_errors=True)
+        in_work("echo resolved > a.txt && git add a.txt")
+        in_work("git -c rerere.enabled=true commit -q --no-edit")
+        errors = gam.merge_upstreams(["develop"], "feature/x", group="feature")
+    assert not errors
+    assert in_tmp("git -C origin.git show feature/x:a.txt") == "resolved"
+    assert list((tmp_path / "rr-cache").iterdir())
+    [record] = [json.loads(line) for line in (tmp_path / "report.jsonl").read_text().splitlines()]
+    assert record["event"] == "edge"
+    assert record["outcome"] == "auto_resolved"
+
+
+@pytest.mark.parametrize("seed", [seed_develop_and_feature_conflict])
+def test_rerere_resolution_rejected_by_a_hook_is_reported_as_a_conflict(
+    origin, tmp_path, mocker, click_context
+):
+    in_tmp = functools.partial(utils.execute_shell, cwd=str(tmp_path))
+    in_tmp(f"git clone -q {origin} work")
+    in_work = functools.partial(utils.execute_shell, cwd=str(tmp_path / "work"))
+    mocker.patch("utils.execute_shell", side_effect=in_work)
+    (tmp_path / "rr-cache").mkdir()
+    with click_context:
+        click_context.params.update(rerere=True, rerere_cache=str(tmp_path / "rr-cache"))
+        gam.configure_rerere()
+        in_work("git checkout -q --detach origin/feature/x", suppress_errors=True)
+        in_work("git -c rerere.enabled=true merge origin/develop", suppress_errors=True)
+        in_work("echo resolved > a.txt && git add a.txt")
+        in_work("git -c rerere.enabled=true commit -q --no-edit")
+        in_work("git checkout -q --detach origin/feature/x")
+        hook = tmp_path / "work" / ".git" / "hooks" / "pre-commit"
+        hook.write_text("#!/bin/sh\necho rejected by hook\nexit 1\n", encoding="utf-8")
+        hook.chmod(0o755)
+        [error] = gam.merge_upstreams(["develop"], "feature/x", group="feature")
+    assert error.conflict
+    assert in_tmp("git -C origin.git show feature/x:a.txt") == "feature"
+    # the failed merge was backed out
+    assert not (tmp_path / "work" / ".git" / "MERGE_HEAD").exists()
+    assert in_work("git status --porcelain") == ""
+
+
+@patch("git_auto_merge.clone")
+def test_cli_rejects_invalid_local_config_before_cloning(clone_mock, mocker, monkeypatch, tmp_path):
+    monkeypatch.setattr(gam, "report_stream_path", None)
+    mocker.patch("git_auto_merge.REPORTS_DIR", str(tmp_path))
+    config_path = tmp_path / "bad.json"
+    config_path.write_text('{"plan": {"root": {"selectors": []}}}', encoding="utf-8")
+    args = ["--repo", "repo.git", "--use-default-plan", "--config-file-name", str(config_path)]
+    result = CliRunner().invoke(gam.cli, args)
+    assert isinstance(result.exception, ValueError)
+    assert "$.plan.root.selectors" in str(result.exception)
+    clone_mock.assert_not_called()
+
+
+@patch("utils.execute_shell")
+def test_merge_all_checks_out_a_shared_branch_once(execute_shell_mock, click_context):
+    with click_context:
+        root = gam.MergeItem(group="root", branch_name="main")
+        root.add_downstream_branch("release/1.0.0", group="release").add_downstream_branch(
+            "bugfix/shared", group="bugfix"
+        )
+        root.add_downstream_branch("release/2.0.0", group="release").add_downstream_branch(
+            "bugfix/shared", group="bugfix"
+        )
+        gam.merge_all(root)
+        commands = [call.args[0] for call in execute_shell_mock.call_args_list]
+        checkouts = [
+            command
+            for command in commands
+            if "checkout -f --detach origin/bugfix/shared" in command
+        ]
+        assert len(checkouts) == 1
+        merges = [command for command in commands if command.startswith("git merge")]
+        assert merges[-2:] == ["git merge origin/release/1.0.0", "git merge origin/release/2.0.0"]
+
+
+def test_merge_error_report_keeps_the_tail_of_long_output():
+    output = "\n".join(str(line) for line in range(1, 1001))
+    err = CalledProcessError(1, "git merge origin/develop", output=output)
+    report = gam.MergeError("develop", "feature/a", err).__json__()
+    lines = report["error"]["output"].splitlines()
+    assert lines[0] == "[... 500 lines omitted ...]"
+    assert lines[1:] == [str(line) for line in range(501, 1001)]
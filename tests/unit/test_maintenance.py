@@ -0,0 +1,52 @@
+import pytest
+from conftest import git
+
+import maintenance
+import utils
+
+
+@pytest.fixture(name="repo")
+def create_repo(tmp_path, monkeypatch, git_identity):
+    monkeypatch.chdir(tmp_path)
+    git(["init", "-q", "-b", "main"], cwd=tmp_path)
+    for index in range(3):
+        git(["commit", "-q", "--allow-empty", "-m", str(index)], cwd=tmp_path)
+    return tmp_path
+
+
+def test_due():
+    assert maintenance.due(20, 20, {}, 6700, 50) == "20 runs since the last maintenance"
+    assert maintenance.due(1, 20, {"count": 6701}, 6700, 50) == "6701 loose objects"
+    assert maintenance.due(1, 20, {"count": 0, "packs": 51}, 6700, 50) == "51 packs"
+    assert not maintenance.due(1, 20, {"count": 10, "packs": 2}, 6700, 50)
+
+
+def test_runs_are_counted_until_maintenance_is_due(repo):
+    state = repo / ".git" / maintenance.STATE_FILE
+    assert not maintenance.maintain(every=3, max_loose_objects=6700, max_packs=50)
+    assert not maintenance.maintain(every=3, max_loose_objects=6700, max_packs=50)
+    assert state.read_text(encoding="utf-8") == '{"runs": 2}'
+    utils.clear_trace()
+    assert maintenance.maintain(every=3, max_loose_objects=6700, max_packs=50)
+    assert state.read_text(encoding="utf-8") == '{"runs": 0}'
+    # the loose commits were packed and a commit-graph with Bloom filters written
+    assert maintenance.object_counts()["count"] == 0
+    assert (repo / ".git" / "objects" / "info" / "commit-graphs").is_dir()
+    [event] = [event for event in utils.trace_events if event["name"] == "maintenance"]
+    assert event["args"]["reason"] == "3 runs since the last maintenance"
+    assert event["args"]["before_seconds"] > 0
+    assert event["args"]["after_seconds"] > 0
+
+
+def test_maintenance_every_zero_turns_it_off(repo):
+    assert not maintenance.maintain(every=0, max_loose_objects=0, max_packs=0)
+    assert not (repo / ".git" / maintenance.STATE_FILE).exists()
+
+
+def test_a_failing_task_is_skipped_and_retried_next_run(repo, monkeypatch):
+    monkeypatch.setattr(maintenance, "TASKS", ("git repack -d --no-such-option",))
+    state = repo / ".git" / maintenance.STATE_FILE
+    assert not maintenance.maintain(every=1, max_loose_objects=6700, max_packs=50)
+    assert state.read_text(encoding="utf-8") == '{"runs": 1}'
+    assert not maintenance.maintain(every=1, max_loose_objects=6700, max_packs=50)
+    assert state.read_text(encoding="utf-8") == '{"runs": 2}'
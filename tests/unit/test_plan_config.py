@@ -0,0 +1,164 @@
+import json
+import re
+
+import pytest
+
+import plan_config
+
+with open(".git-auto-merge.schema.json", encoding="utf-8") as schema_file:
+    SCHEMA = json.load(schema_file)
+NODE_SCHEMA = SCHEMA["$defs"]["node"]
+FOR_EACH_SCHEMA = NODE_SCHEMA["properties"]["downstreamForEach"]
+# every object the schema describes, by where it sits in a config
+SCHEMA_OBJECTS = [
+    ("$", SCHEMA),
+    ("$.plan", SCHEMA["properties"]["plan"]),
+    ("$.plan.root", NODE_SCHEMA),
+    ("$.plan.root.downstreamForEach", FOR_EACH_SCHEMA),
+]
+# a value of some other JSON type than the schema asks for
+WRONG_TYPE_VALUES = {"string": 1, "integer": "1", "object": [], "array": {}}
+
+
+def full_config():
+    # sets every property the schema describes
+    develop = {"selectors": [{"name": "develop"}]}
+    for_each = {"matchOn": "version", "matchedSelectors": [{"regex": r"^release/(\d+)"}]}
+    root = {
+        "selectors": [{"name": "main"}],
+        "sort": "version",
+        "weight": 1,
+        "downstreamForEach": for_each,
+        "downstream": {"develop": develop},
+    }
+    return {"version": 1, "repo_path": "repo", "plan": {"root": root}}
+
+
+def config_object(config, path):
+    for key in path.split(".")[1:]:
+        config = config[key]
+    return config
+
+
+def schema_type(property_schema):
+    if "$ref" in property_schema:
+        return SCHEMA["$defs"][property_schema["$ref"].split("/")[-1]]["type"]
+    return property_schema["type"]
+
+
+def load(path):
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def config_with_root(root):
+    return {"version": 1, "plan": {"root": root}}
+
+
+def test_compiler_keys_match_the_schema():
+    assert set(SCHEMA["properties"]) == plan_config.CONFIG_KEYS
+    assert set(NODE_SCHEMA["properties"]) == plan_config.NODE_KEYS
+    assert set(FOR_EACH_SCHEMA["properties"]) == plan_config.FOR_EACH_KEYS
+    assert set(FOR_EACH_SCHEMA["properties"]["matchOn"]["enum"]) == plan_config.MATCH_ON_TYPES
+    assert set(NODE_SCHEMA["properties"]["sort"]["enum"]) == plan_config.SORT_TYPES
+    assert SCHEMA["properties"]["version"]["const"] == plan_config.CONFIG_VERSION
+
+
+def test_every_property_in_the_schema_compiles():
+    config = full_config()
+    for path, schema in SCHEMA_OBJECTS:
+        assert set(config_object(config, path)) == set(schema["properties"]), path
+    plan_config.compile_config(config)
+
+
+@pytest.mark.parametrize(
+    ("path", "key"),
+    [(path, key) for path, schema in SCHEMA_OBJECTS for key in schema["required"]],
+)
+def test_compiler_requires_what_the_schema_requires(path, key):
+    config = full_config()
+    del config_object(config, path)[key]
+    with pytest.raises(ValueError, match=rf"at {re.escape(path)}: missing required key '{key}'"):
+        plan_config.compile_config(config)
+
+
+@pytest.mark.parametrize(
+    ("path", "key"),
+    [(path, key) for path, schema in SCHEMA_OBJECTS for key in schema["properties"]],
+)
+def test_compiler_checks_the_types_in_the_schema(path, key):
+    config = full_config()
+    property_type = schema_type(dict(SCHEMA_OBJECTS)[path]["properties"][key])
+    config_object(config, path)[key] = WRONG_TYPE_VALUES[property_type]
+    with pytest.raises(ValueError, match=rf"at {re.escape(path)}\.{key}: "):
+        plan_config.compile_config(config)
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        ".git-auto-merge.json",
+        "tests/unit/multi-project-config.json",
+        "tests/unit/test_files/weird_branch_bug.json",
+    ],
+)
+def test_repo_configs_compile(path):
+    program = plan_config.compile_config(load(path))
+    assert program.group == "root"
+    assert program.selectors
+
+
+def test_compile_config_resolves_nodes():
+    program = plan_config.compile_config(load(".git-auto-merge.json"))
+    [release] = program.downstream
+    assert release.group == "release"
+    assert release.sort_type == "version"
+    assert release.for_each is not None
+    assert release.for_each.match_on == "version"
+    assert release.selectors[0].select(["hotfix/1.0.1", "develop"]) == ["hotfix/1.0.1"]
+    assert program.selectors[0].select(["develop", "main"]) == ["main"]
+    assert program.selectors[0].select(["develop"]) == []
+
+
+@pytest.mark.parametrize(
+    ("config", "message"),
+    [
+        ({"plan": {}}, r"\$\.plan: missing required key 'root'"),
+        ({"plan": {"root": {}}, "extra": 1}, r"\$: unknown keys \['extra'\]"),
+        ({"version": 2, "plan": {"root": {}}}, r"\$\.version: expected 1"),
+        (config_with_root({"selectors": []}), r"\$\.plan\.root\.selectors: expected a non-empty"),
+        (
+            config_with_root({"selectors": [{"name": "main", "regex": "^m"}]}),
+            r"selectors\[0\]: a selector has exactly one",
+        ),
+        (
+            config_with_root({"selectors": [{"regex": "("}]}),
+            r"selectors\[0\]\.regex: invalid regex",
+        ),
+        (
+            config_with_root({"selectors": [{"name": "main"}], "sort": "semver"}),
+            r"\$\.plan\.root\.sort: expected one of \['version'\]",
+        ),
+        (
+            config_with_root(
+                {
+                    "selectors": [{"name": "main"}],
+                    "downstream": {"develop": {"selectors": [{"name": ""}]}},
+                }
+            ),
+            r"\$\.plan\.root\.downstream\.develop\.selectors\[0\]\.name",
+        ),
+        (
+            config_with_root(
+                {
+                    "selectors": [{"name": "main"}],
+                    "downstreamForEach": {"matchOn": "tag", "matchedSelectors": [{"name": "a"}]},
+                }
+            ),
+            r"downstreamForEach\.matchOn: expected one of \['branch', 'version'\]",
+        ),
+    ],
+)
+def test_invalid_configs_are_rejected_with_their_path(config, message):
+    with pytest.raises(ValueError, match=message):
+        plan_config.compile_config(config)
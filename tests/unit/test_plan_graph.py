@@ -0,0 +1,50 @@
+import git_auto_merge as gam
+import plan_graph
+
+
+def diamond_plan():
+    # main feeds two release branches that both carry bugfix/shared
+    root = gam.MergeItem(group="root", branch_name="main")
+    release_1 = root.add_downstream_branch("release/1.0.0", group="release")
+    release_2 = root.add_downstream_branch("release/2.0.0", group="release")
+    release_1.add_downstream_branch("bugfix/shared", group="bugfix")
+    release_2.add_downstream_branch("bugfix/shared", group="bugfix")
+    release_2.add_downstream_branch("develop", group="develop")
+    return root
+
+
+def test_repeated_branch_becomes_one_node_with_several_upstreams():
+    graph = plan_graph.build_graph(diamond_plan())
+    assert graph.upstreams["bugfix/shared"] == ["release/1.0.0", "release/2.0.0"]
+    assert graph.groups["bugfix/shared"] == "bugfix"
+    assert graph.topological_order() == [
+        "main",
+        "release/1.0.0",
+        "release/2.0.0",
+        "bugfix/shared",
+        "develop",
+    ]
+
+
+def test_topological_order_follows_the_plan_order_for_a_tree():
+    root = gam.MergeItem(group="root", branch_name="main")
+    hotfix = root.add_downstream_branch("hotfix/1.0.1", group="release")
+    develop = hotfix.add_downstream_branch("develop", group="develop")
+    develop.add_downstream_branch("feature/a", group="feature")
+    hotfix.add_downstream_branch("bugfix/1.0.1/x", group="release")
+    graph = plan_graph.build_graph(root)
+    assert graph.edges() == [
+        ("main", "hotfix/1.0.1"),
+        ("hotfix/1.0.1", "develop"),
+        ("develop", "feature/a"),
+        ("hotfix/1.0.1", "bugfix/1.0.1/x"),
+    ]
+
+
+def test_edges_that_would_close_a_cycle_are_skipped():
+    root = gam.MergeItem(group="root", branch_name="main")
+    develop = root.add_downstream_branch("develop", group="develop")
+    develop.add_downstream_branch("main", group="feature")
+    graph = plan_graph.build_graph(root)
+    assert graph.edges() == [("main", "develop")]
+    assert str(graph) == "main -> develop"
@@ -0,0 +1,66 @@
+import pytest
+from conftest import git
+
+import refs
+import utils
+
+
+def seed_branches_and_tag(seed):
+    git(["commit", "--allow-empty", "-m", "initial"], cwd=seed)
+    for branch in ("develop", "feature/a", "feature/b/c", "release/1.0.0"):
+        git(["branch", branch], cwd=seed)
+    git(["tag", "-a", "v1", "-m", "v1"], cwd=seed)
+
+
+@pytest.fixture(name="seed")
+def create_seed():
+    return seed_branches_and_tag
+
+
+@pytest.fixture(name="clone")
+def create_clone(origin, tmp_path):
+    clone = tmp_path / "clone"
+    git(["clone", str(origin), str(clone)], cwd=tmp_path)
+    return clone
+
+
+def branch_list_from_git(clone):
+    # the command get_branch_list_raw runs
+    output = utils.execute_shell("git branch -r | sed 's|origin/||' | grep -v HEAD", cwd=clone)
+    return [line.strip() for line in output.splitlines()]
+
+
+def test_matches_git_for_packed_and_loose_refs(clone):
+    git(["pack-refs", "--all"], cwd=clone)
+    # a newer loose ref overrides its packed entry, and new branches start loose
+    git(["update-ref", "refs/remotes/origin/develop", "HEAD"], cwd=clone)
+    git(["update-ref", "refs/remotes/origin/feature/loose", "HEAD"], cwd=clone)
+    shas = refs.remote_branches(str(clone))
+    assert list(shas) == branch_list_from_git(clone)
+    for branch, sha in shas.items():
+        assert sha == git(["rev-parse", f"refs/remotes/origin/{branch}"], cwd=clone)
+
+
+def test_large_packed_refs_are_memory_mapped(clone, monkeypatch):
+    git(["pack-refs", "--all"], cwd=clone)
+    monkeypatch.setattr(refs, "PACKED_REFS_MMAP_BYTES", 1)
+    assert list(refs.remote_branches(str(clone))) == branch_list_from_git(clone)
+
+
+def test_unsorted_packed_refs_are_scanned_in_full():
+    data = b"aaaa refs/tags/v1\n^bbbb\n" + b"1" * 40 + b" refs/remotes/origin/main\n"
+    data += b"cccc refs/heads/main\n" + b"2" * 40 + b" refs/remotes/origin/develop\n"
+    assert refs.parse_packed_refs(data, b"refs/remotes/origin/") == {
+        "main": "1" * 40,
+        "develop": "2" * 40,
+    }
+
+
+def test_falls_back_to_git_for_layouts_it_does_not_read(clone, tmp_path):
+    (clone / ".git" / "reftable").mkdir()
+    assert refs.remote_branches(str(clone)) is None
+    assert refs.remote_branches(str(tmp_path / "missing")) is None
+    worktree = tmp_path / "worktree"
+    worktree.mkdir()
+    (worktree / ".git").write_text("gitdir: ../clone/.git/worktrees/x\n", encoding="utf-8")
+    assert refs.remote_branches(str(worktree)) is None
@@ -0,0 +1,76 @@
+import pytest
+from conftest import git
+
+import git_auto_merge as gam
+
+CONFIG = {
+    "plan": {
+        "root": {
+            "selectors": [{"name": "main"}],
+            "downstream": {
+                "develop": {
+                    "selectors": [{"name": "develop"}],
+                    "downstream": {"feature": {"selectors": [{"regex": "^feature/"}]}},
+                }
+            },
+        }
+    }
+}
+
+
+def seed_clean_and_clashing_features(seed):
+    # feature/clash changes the same line as main, so merging develop into it conflicts
+    (seed / "a.txt").write_text("base\n", encoding="utf-8")
+    git(["add", "."], cwd=seed)
+    git(["commit", "-m", "base"], cwd=seed)
+    git(["branch", "develop"], cwd=seed)
+    for branch, content in (("feature/clean", None), ("feature/clash", "clash\n")):
+        git(["checkout", "-b", branch, "main"], cwd=seed)
+        if content:
+            (seed / "a.txt").write_text(content, encoding="utf-8")
+        git(["commit", "-am", branch, "--allow-empty"], cwd=seed)
+    git(["checkout", "main"], cwd=seed)
+    (seed / "a.txt").write_text("main\n", encoding="utf-8")
+    git(["commit", "-am", "main"], cwd=seed)
+
+
+@pytest.fixture(name="seed")
+def create_seed():
+    return seed_clean_and_clashing_features
+
+
+def test_run_returns_results_instead_of_exiting(origin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    result = gam.run(str(origin), CONFIG, {"work_dir": str(tmp_path / "work")})
+    assert not result.ok
+    outcomes = {edge["edge"]: edge["outcome"] for edge in result.edges}
+    assert outcomes == {
+        "main -> develop": "merged",
+        "develop -> feature/clash": "conflict",
+        "develop -> feature/clean": "merged",
+    }
+    [error] = result.errors
+    assert (error.merge_from, error.merge_to, error.conflict) == ("develop", "feature/clash", True)
+    assert result.timings["run"] >= result.timings["clone"] > 0
+    main = git(["rev-parse", "main"], cwd=origin)
+    assert git(["merge-base", "main", "feature/clean"], cwd=origin) == main
+
+
+def test_run_rejects_unknown_options_and_invalid_config(tmp_path):
+    with pytest.raises(ValueError, match="Unknown options"):
+        gam.run("repo.git", CONFIG, {"workdir": str(tmp_path)})
+    with pytest.raises(ValueError, match="Invalid config"):
+        gam.run("repo.git", {"plan": {}}, {"work_dir": str(tmp_path)})
+
+
+def test_dry_run_keeps_merge_results_out_of_local_branches(origin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    before = git(["rev-parse", "develop"], cwd=origin)
+    options = {"work_dir": str(tmp_path / "work"), "dry_run": True}
+    gam.run(str(origin), CONFIG, options)
+    clone = tmp_path / "work" / "origin"
+    assert git(["rev-parse", "develop"], cwd=origin) == before
+    merged = "refs/git-auto-merge/dry-run/develop"
+    assert git(["merge-base", "--is-ancestor", "origin/main", merged], cwd=clone) == ""
+    heads = git(["for-each-ref", "--format=%(refname)", "refs/heads"], cwd=clone)
+    assert heads == "refs/heads/main"
@@ -0,0 +1,95 @@
+import json
+from unittest.mock import patch
+
+import click
+import pytest
+
+import git_auto_merge as gam
+import plan_config
+import plan_graph
+import scheduler
+
+
+def release_plan():
+    root = gam.MergeItem(group="root", branch_name="main")
+    root.add_downstream_branch("release/1.0.0", group="release")
+    develop = root.add_downstream_branch("develop", group="develop")
+    develop.add_downstream_branch("feature/a", group="feature")
+    develop.add_downstream_branch("feature/b", group="feature")
+    return root
+
+
+def test_parse_priorities():
+    assert scheduler.parse_priorities(None) == []
+    assert scheduler.parse_priorities("weight, behind") == ["weight", "behind"]
+    with pytest.raises(ValueError, match="Unknown priority 'age'"):
+        scheduler.parse_priorities("age")
+
+
+def test_without_priorities_the_plan_order_is_kept():
+    graph = plan_graph.build_graph(release_plan())
+    assert scheduler.Scheduler().order(graph) == graph.topological_order()
+
+
+def test_weight_merges_heavier_groups_first_but_after_their_upstreams():
+    graph = plan_graph.build_graph(release_plan())
+    schedule = scheduler.Scheduler(["weight"], {"develop": 5, "feature": 10})
+    assert schedule.order(graph) == ["main", "develop", "feature/a", "feature/b", "release/1.0.0"]
+
+
+def test_staleness_merges_the_branch_furthest_behind_its_upstream_first():
+    graph = plan_graph.build_graph(release_plan())
+    dates = {"main": 100, "release/1.0.0": 99, "develop": 10, "feature/a": 5, "feature/b": 1}
+    with patch("scheduler.commit_dates", return_value=dates):
+        order = scheduler.Scheduler(["staleness"]).order(graph)
+    assert order == ["main", "develop", "feature/b", "feature/a", "release/1.0.0"]
+
+
+def test_behind_merges_the_branch_missing_most_commits_first():
+    graph = plan_graph.build_graph(release_plan())
+    behind = {"release/1.0.0": 1, "develop": 3, "feature/a": 2, "feature/b": 4}
+    with patch("scheduler.commits_behind", side_effect=lambda branch, _: behind[branch]):
+        order = scheduler.Scheduler(["behind"]).order(graph)
+    assert order == ["main", "develop", "feature/b", "feature/a", "release/1.0.0"]
+
+
+def test_group_weights_come_from_the_config():
+    config = {"plan": {"root": {"selectors": [{"name": "main"}], "weight": 1}}}
+    assert plan_config.group_weights(plan_config.compile_config(config)) == {"root": 1}
+    config["plan"]["root"]["weight"] = "high"
+    with pytest.raises(ValueError, match=r"\$\.plan\.root\.weight"):
+        plan_config.compile_config(config)
+
+
+def test_merges_past_the_deadline_are_deferred(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gam.start_report()
+    schedule = scheduler.Scheduler(max_duration=0)
+    with click.Context(gam.cli), patch("git_auto_merge.merge_upstreams") as merge_upstreams:
+        assert gam.merge_all(release_plan(), schedule) == []
+    merge_upstreams.assert_not_called()
+    lines = (tmp_path / "reports" / "report.jsonl").read_text(encoding="utf-8").splitlines()
+    deferred = [json.loads(line) for line in lines]
+    assert {record["event"] for record in deferred} == {"deferred"}
+    assert [record["merge_to"] for record in deferred] == [
+        "release/1.0.0",
+        "develop",
+        "feature/a",
+        "feature/b",
+    ]
+
+
+def test_shards_only_order_by_the_config_weight():
+    priorities = scheduler.parse_priorities("staleness,weight,behind")
+    assert scheduler.shard_priorities(priorities) == ["weight"]
+    graph = plan_graph.build_graph(release_plan())
+    schedule = scheduler.Scheduler(scheduler.shard_priorities(priorities), {"feature": 10})
+    with patch("utils.execute_shell") as execute_shell:
+        assert schedule.order(graph) == [
+            "main",
+            "release/1.0.0",
+            "develop",
+            "feature/a",
+            "feature/b",
+        ]
+    execute_shell.assert_not_called()
@@ -0,0 +1,207 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+from unittest.mock import patch
+
+import click
+import pytest
+from click.testing import CliRunner
+from conftest import git
+
+import git_auto_merge as gam
+import plan_graph
+import sharding
+import utils
+
+FEATURES = ["feature/a", "feature/b", "feature/c", "feature/d"]
+
+
+def seed_features(seed):
+    git(["commit", "--allow-empty", "-m", "initial"], cwd=seed)
+    git(["branch", "develop"], cwd=seed)
+    for branch in FEATURES:
+        git(["checkout", "-b", branch, "main"], cwd=seed)
+        (seed / branch.replace("/", "-")).write_text(branch, encoding="utf-8")
+        git(["add", "."], cwd=seed)
+        git(["commit", "-m", branch], cwd=seed)
+    for branch in ("develop", "main"):
+        git(["checkout", branch], cwd=seed)
+        (seed / f"{branch}.txt").write_text(branch, encoding="utf-8")
+        git(["add", "."], cwd=seed)
+        git(["commit", "-m", branch], cwd=seed)
+
+
+@pytest.fixture(name="seed")
+def create_seed():
+    return seed_features
+
+
+def fan_out_root():
+    root = gam.MergeItem(group="root", branch_name="main")
+    hotfix = root.add_downstream_branch("hotfix/1.0.1", group="release")
+    develop = hotfix.add_downstream_branch("develop", group="develop")
+    for branch in FEATURES:
+        develop.add_downstream_branch(branch, group="feature")
+    return root
+
+
+def fan_out_plan():
+    return plan_graph.build_graph(fan_out_root())
+
+
+def test_parse_shard():
+    assert sharding.parse_shard("2/4") == (2, 4)
+    with pytest.raises(ValueError, match="between 1 and 4"):
+        sharding.parse_shard("5/4")
+    with pytest.raises(ValueError, match="like 1/4"):
+        sharding.parse_shard("two")
+
+
+def test_chains_stay_in_one_unit_and_fan_out_splits():
+    heads = sharding.unit_heads(fan_out_plan())
+    assert heads["hotfix/1.0.1"] == heads["develop"] == "hotfix/1.0.1"
+    assert all(heads[branch] == branch for branch in FEATURES)
+
+
+def test_assignment_is_deterministic_and_covers_every_merged_branch():
+    graph = fan_out_plan()
+    owners = sharding.assign_shards(graph, 3)
+    assert owners == sharding.assign_shards(fan_out_plan(), 3)
+    assert set(owners) == {"hotfix/1.0.1", "develop", *FEATURES}
+    assert set(owners.values()) <= {1, 2, 3}
+    assert owners["hotfix/1.0.1"] == owners["develop"]
+
+
+def test_worker_command_passes_flags_turned_off():
+    params = {"repo": "repo.git", "ssh_mux": False, "lfs": False, "dry_run": True}
+    command = sharding.worker_command(gam.cli, {**params, "shard_dir": "shards"}, 1, 2, "work")
+    assert "--no-ssh-mux" in command
+    assert "--dry-run" in command
+    assert "--lfs" not in command
+
+
+def test_worker_command_gives_each_shard_its_own_outputs():
+    params = {"shard_dir": "shards", "profile_out": "trace.json", "command_log_dir": "logs"}
+    first, second = (sharding.worker_command(gam.cli, params, index, 2, "work") for index in (1, 2))
+    for index, command in enumerate((first, second), 1):
+        options = dict(zip(command, command[1:]))
+        assert options["--profile-out"] == sharding.output_path("shards", index, "trace.json")
+        assert options["--command-log-dir"] == os.path.join("logs", f"shard-{index}")
+    assert "trace.json" not in first + second
+
+
+def test_wait_for_returns_once_marked_done(tmp_path):
+    assert not sharding.wait_for(str(tmp_path), "develop", 2, deadline=0)
+    sharding.mark_done(str(tmp_path), "develop")
+    assert sharding.wait_for(str(tmp_path), "develop", 2, deadline=0)
+
+
+def test_wait_for_stops_when_the_owner_failed(tmp_path):
+    sharding.mark_failed(str(tmp_path), 2)
+    deadline = time.monotonic() + 60
+    assert not sharding.wait_for(str(tmp_path), "develop", 2, deadline)
+    assert time.monotonic() < deadline - 50
+
+
+def test_failed_shard_is_marked_while_the_others_still_run(tmp_path):
+    failed = sharding.failed_path(str(tmp_path), 1)
+    # the second worker only exits 0 if it sees the first one's failure marker
+    waiter = f"import os, sys, time\nfor _ in range(100):\n    if os.path.exists({failed!r}):\n"
+    waiter += "        sys.exit(0)\n    time.sleep(0.1)\nsys.exit(2)\n"
+    workers = [
+        subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"]),
+        subprocess.Popen([sys.executable, "-c", waiter]),
+    ]
+    assert sharding.wait_for_workers(str(tmp_path), workers) == [3, 0]
+    assert not os.path.exists(sharding.failed_path(str(tmp_path), 2))
+
+
+def test_a_branch_waits_on_all_its_upstreams_until_one_deadline(tmp_path):
+    root = gam.MergeItem(group="root", branch_name="main")
+    for release in ("release/1.0.0", "release/2.0.0"):
+        root.add_downstream_branch(release, group="release").add_downstream_branch(
+            "bugfix/shared", group="bugfix"
+        )
+    graph = plan_graph.build_graph(root)
+    owners = {"release/1.0.0": 2, "release/2.0.0": 3, "bugfix/shared": 1}
+    context = click.Context(gam.cli)
+    context.params = {"shard_dir": str(tmp_path), "shard_timeout": 30}
+    with context, patch("sharding.wait_for", return_value=False) as wait_for:
+        ready, errors = gam.wait_for_other_shards(graph, owners, "bugfix/shared")
+    assert not ready
+    assert [error.merge_from for error in errors] == ["release/1.0.0", "release/2.0.0"]
+    owners_waited = [call.args[2] for call in wait_for.call_args_list]
+    deadlines = {call.args[3] for call in wait_for.call_args_list}
+    assert owners_waited == [2, 3]
+    assert len(deadlines) == 1
+
+
+def test_giving_up_on_another_shard_is_streamed_to_the_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    owners = sharding.assign_shards(fan_out_plan(), 2)
+    index = next(owners[branch] for branch in FEATURES if owners[branch] != owners["develop"])
+    shard_dir = str(tmp_path / "shards")
+    sharding.reset_shard_dir(shard_dir)
+    gam.start_report(sharding.report_path(shard_dir, index))
+    context = click.Context(gam.cli)
+    context.params = {"shard": f"{index}/2", "shard_dir": shard_dir, "shard_timeout": 0}
+    with context, patch("git_auto_merge.merge_upstreams", return_value=[]):
+        errors = gam.merge_all(fan_out_root())
+        with pytest.raises(SystemExit):
+            gam.handle_errors(errors)
+    waited = sorted(branch for branch in FEATURES if owners[branch] == index)
+    assert sorted(error.merge_to for error in errors) == waited
+    # the coordinator combines this worker's errors instead of calling it abnormal
+    assert sharding.reported_errors(shard_dir, index)
+    with open(sharding.output_path(shard_dir, index, "errors.json"), encoding="utf-8") as file:
+        report = json.load(file)
+    assert sorted(error["merge_to"] for error in report) == waited
+    assert {error["merge_from"] for error in report} == {"develop"}
+
+
+def test_coordinator_runs_shards_in_separate_clones(origin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(os.path.abspath(path) for path in sys.path))
+    # the coordinator's start_run sets this for the rest of the process
+    monkeypatch.setattr(utils, "command_log_dir", None)
+    feature = {"selectors": [{"regex": "^feature/"}]}
+    develop = {"selectors": [{"name": "develop"}], "downstream": {"feature": feature}}
+    config = {
+        "plan": {"root": {"selectors": [{"name": "main"}], "downstream": {"develop": develop}}}
+    }
+    (tmp_path / "plan.json").write_text(json.dumps(config), encoding="utf-8")
+    args = ["--repo", str(origin), "--work-dir", str(tmp_path / "work"), "--use-default-plan"]
+    args += ["-c", "plan.json", "--config-branch", "main", "--report-edges", "--shards", "2"]
+    args += ["--profile-out", "trace.json", "--command-log-dir", "logs"]
+    owners = {zlib.crc32(branch.encode()) % 2 for branch in ["develop", *FEATURES]}
+    assert owners == {0, 1}, "some features must wait on develop from the other shard"
+    result = CliRunner().invoke(gam.cli, args)
+    assert result.exit_code == 0, result.output
+    # every shard cloned for itself, and features merged develop only after it had main
+    assert {path.name for path in (tmp_path / "work").iterdir()} >= {"shard-1", "shard-2"}
+    main = git(["rev-parse", "main"], cwd=origin)
+    for branch in ["develop", *FEATURES]:
+        ancestor = ["git", "merge-base", "--is-ancestor", main, branch]
+        assert subprocess.run(ancestor, cwd=origin, check=False).returncode == 0, branch
+    # merges ran on a detached HEAD, so the clones only have the default branch locally
+    for shard in ("shard-1", "shard-2"):
+        clone = tmp_path / "work" / shard / "origin"
+        assert (
+            git(["for-each-ref", "--format=%(refname)", "refs/heads"], cwd=clone)
+            == "refs/heads/main"
+        )
+    lines = (tmp_path / "reports" / "report.jsonl").read_text(encoding="utf-8").splitlines()
+    edges = sorted(json.loads(line)["merge_to"] for line in lines)
+    assert edges == ["develop", *FEATURES]
+    # the coordinator combines the workers' traces and metrics; their logs stay apart
+    trace = json.loads((tmp_path / "trace.json").read_text(encoding="utf-8"))["traceEvents"]
+    runs = [event for event in trace if event["name"] == "run"]
+    assert len({event["pid"] for event in runs}) == 3
+    metrics = (tmp_path / "reports" / "metrics.prom").read_text(encoding="utf-8")
+    counts = [line for line in metrics.splitlines() if line.startswith("git_auto_merge_edges{")]
+    assert sum(int(line.split()[-1]) for line in counts) == len(edges)
+    for shard in ("shard-1", "shard-2"):
+        assert any((tmp_path / "logs" / shard).glob("0001-*.log"))
@@ -0,0 +1,34 @@
+"""Cold-start budget for importing the CLI module in a fresh interpreter."""
+
+import os
+import subprocess
+import sys
+
+# cumulative import time of git_auto_merge as reported by -X importtime
+IMPORT_TIME_BUDGET_US = 150_000
+
+LAZY_MODULES = ["loguru", "packaging.version", "urllib.request"]
+
+
+def import_in_fresh_interpreter(code):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+
+
+def test_heavy_dependencies_are_not_imported_at_startup():
+    code = f"import sys, git_auto_merge; print([m for m in {LAZY_MODULES!r} if m in sys.modules])"
+    result = import_in_fresh_interpreter(code)
+    assert result.stdout.strip() == "[]"
+
+
+def test_import_time_is_within_budget():
+    result = import_in_fresh_interpreter("import git_auto_merge")
+    [line] = [line for line in result.stderr.splitlines() if line.endswith("| git_auto_merge")]
+    cumulative_us = int(line.split("|")[1])
+    assert cumulative_us < IMPORT_TIME_BUDGET_US
@@ -0,0 +1,231 @@
+import heapq
+import json
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from conftest import git
+
+import git_auto_merge as gam
+import plan_graph
+import status
+import utils
+
+
+def seed_behind_and_ahead(seed):
+    # develop is 2 commits behind main; feature/a is 1 ahead of develop
+    git(["commit", "--allow-empty", "-m", "base"], cwd=seed)
+    git(["branch", "develop"], cwd=seed)
+    git(["checkout", "-b", "feature/a"], cwd=seed)
+    git(["commit", "--allow-empty", "-m", "feature"], cwd=seed)
+    git(["checkout", "main"], cwd=seed)
+    git(["commit", "--allow-empty", "-m", "one"], cwd=seed)
+    git(["commit", "--allow-empty", "-m", "two"], cwd=seed)
+
+
+@pytest.fixture(name="seed")
+def create_seed():
+    return seed_behind_and_ahead
+
+
+def status_args(origin, tmp_path) -> list[str]:
+    feature = {"selectors": [{"regex": "^feature/"}]}
+    develop = {"selectors": [{"name": "develop"}], "downstream": {"feature": feature}}
+    config = {
+        "plan": {"root": {"selectors": [{"name": "main"}], "downstream": {"develop": develop}}}
+    }
+    (tmp_path / "plan.json").write_text(json.dumps(config), encoding="utf-8")
+    args = ["--repo", str(origin), "--work-dir", str(tmp_path / "work"), "--use-default-plan"]
+    return [*args, "-c", "plan.json", "--config-branch", "main"]
+
+
+def test_status_prints_behind_and_ahead_for_every_edge(origin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = [*status_args(origin, tmp_path), "status"]
+    result = CliRunner().invoke(gam.cli, [*args, "--format", "json"])
+    assert result.exit_code == 0, result.output
+    rows = json.loads(result.stdout)
+    counts = [(row["upstream"], row["downstream"], row["behind"], row["ahead"]) for row in rows]
+    assert counts == [("main", "develop", 2, 0), ("develop", "feature/a", 0, 1)]
+    assert all(row["upstream_date"] and row["downstream_date"] for row in rows)
+    table = CliRunner().invoke(gam.cli, args).stdout.splitlines()
+    assert table[0].split() == list(status.COLUMNS)
+    upstream, downstream, _, behind, ahead, *_ = table[1].split()
+    assert (upstream, downstream, behind, ahead) == ("main", "develop", "2", "0")
+    # nothing was merged
+    assert git(["rev-list", "--count", "main..develop"], cwd=origin) == "0"
+    assert git(["rev-list", "--count", "develop..main"], cwd=origin) == "2"
+
+
+def test_ahead_behind_reads_every_edge_from_one_for_each_ref():
+    root = gam.MergeItem(group="root", branch_name="main")
+    develop = root.add_downstream_branch("develop", group="develop")
+    develop.add_downstream_branch("feature/a", group="feature")
+    edges = plan_graph.build_graph(root).edges()
+    # one atom per upstream, in sorted order: develop, then main
+    output = "HEAD 0 0 2 0\ndevelop 0 0 0 2\nfeature/a 1 0 1 2\nmain 0 0 2 0"
+    with patch("utils.execute_shell", return_value=output) as execute_shell:
+        counts = status.ahead_behind(edges)
+    [command] = [call.args[0] for call in execute_shell.call_args_list]
+    assert "%(ahead-behind:origin/develop) %(ahead-behind:origin/main)" in command
+    # only the planned downstreams' namespaces are listed
+    assert command.endswith(" refs/remotes/origin/develop refs/remotes/origin/feature")
+    assert counts == {("main", "develop"): (2, 0), ("develop", "feature/a"): (0, 1)}
+
+
+def seed_merges(seed):
+    # criss-cross merges between develop and feature/a, and a release cut from main
+    git(["commit", "--allow-empty", "-m", "base"], cwd=seed)
+    for branch in ("develop", "feature/a", "release/1.0.0"):
+        git(["branch", branch], cwd=seed)
+    for branch, other in (("develop", "feature/a"), ("feature/a", "develop")):
+        git(["checkout", branch], cwd=seed)
+        git(["commit", "--allow-empty", "-m", f"{branch} 1"], cwd=seed)
+        git(["merge", "--no-ff", "-m", f"{other} into {branch}", other], cwd=seed)
+        git(["commit", "--allow-empty", "-m", f"{branch} 2"], cwd=seed)
+    git(["checkout", "main"], cwd=seed)
+    for index in range(3):
+        git(["commit", "--allow-empty", "-m", f"main {index}"], cwd=seed)
+    git(["merge", "--no-ff", "-m", "develop into main", "develop"], cwd=seed)
+
+
+@pytest.mark.parametrize("seed", [seed_merges])
+def test_walked_counts_match_rev_list(origin, tmp_path, monkeypatch):
+    git(["clone", str(origin), str(tmp_path / "clone")], cwd=tmp_path)
+    monkeypatch.chdir(tmp_path / "clone")
+    branches = ["main", "develop", "feature/a", "release/1.0.0"]
+    edges = [(upstream, downstream) for upstream in branches for downstream in branches]
+    with patch("utils.execute_shell", wraps=utils.execute_shell) as execute_shell:
+        counts = status.walked_counts(edges)
+    # one rev-list; the branch tips come from the ref files
+    assert execute_shell.call_count == 1
+    for upstream, downstream in edges:
+        command = [
+            "rev-list",
+            "--left-right",
+            "--count",
+            f"origin/{upstream}...origin/{downstream}",
+        ]
+        behind, ahead = git(command, cwd=".").split()
+        assert counts[upstream, downstream] == (int(behind), int(ahead)), (upstream, downstream)
+
+
+def seed_long_divergent_history(seed):
+    # 20,000 shared commits; then main and develop diverge by 100 each, and 20 feature
+    # branches cut from develop take 10 commits and a merge of main
+    stream = []
+
+    def commit(branch, mark, parent=None, merge=None):
+        stream.append(f"commit refs/heads/{branch}\nmark :{mark}\n")
+        stream.append(f"committer test <test@example.com> {mark} +0000\ndata 0\n")
+        stream.append(f"from :{parent}\n" if parent else "")
+        stream.append(f"merge :{merge}\n" if merge else "")
+
+    for mark in range(1, 20001):
+        commit("main", mark, mark - 1 if mark > 1 else None)
+    develop_tips = [20000]
+    for index in range(100):
+        commit("main", 20101 + index, 20100 + index if index else 20000)
+        develop_tips.append(20201 + index)
+        commit("develop", develop_tips[-1], develop_tips[-2])
+    mark = 30000
+    for feature in range(20):
+        parent = develop_tips[feature * 5]
+        for _ in range(10):
+            mark += 1
+            commit(f"feature/{feature}", mark, parent)
+            parent = mark
+        mark += 1
+        commit(f"feature/{feature}", mark, parent, merge=20200)
+    stream.append("done\n")
+    subprocess.run(
+        ["git", "fast-import", "--quiet", "--done"],
+        input="".join(stream),
+        text=True,
+        cwd=seed,
+        check=True,
+    )
+    git(["checkout", "-q", "main"], cwd=seed)
+
+
+@pytest.mark.parametrize("seed", [seed_long_divergent_history])
+def test_walked_counts_only_walk_the_divergent_commits(origin, tmp_path, monkeypatch):
+    git(["clone", "-q", str(origin), str(tmp_path / "clone")], cwd=tmp_path)
+    monkeypatch.chdir(tmp_path / "clone")
+    features = [f"feature/{index}" for index in range(20)]
+    edges = [("main", "develop")]
+    edges += [(upstream, feature) for feature in features for upstream in ("develop", "main")]
+    with patch("heapq.heappop", wraps=heapq.heappop) as heappop:
+        counts = status.walked_counts(edges)
+    for upstream, downstream in edges:
+        range_ = f"origin/{upstream}...origin/{downstream}"
+        behind, ahead = git(["rev-list", "--left-right", "--count", range_], cwd=".").split()
+        assert counts[upstream, downstream] == (int(behind), int(ahead)), (upstream, downstream)
+    # every edge stops at its merge base: all 41 walks together visit fewer commits
+    # than the shared history holds
+    assert heappop.call_count < 20000
+
+
+def test_ref_patterns_name_only_the_planned_namespaces():
+    assert status.ref_patterns(["main", "feature/a", "feature/b", "release/1.0.0"]) == (
+        "refs/remotes/origin/feature refs/remotes/origin/main refs/remotes/origin/release"
+    )
+    branches = [f"branch-{index}" for index in range(5000)]
+    assert status.ref_patterns(branches) == "refs/remotes/origin"
+
+
+def test_remote_heads_skip_unplanned_refs(origin, tmp_path, monkeypatch):
+    clone = tmp_path / "clone"
+    git(["clone", "-q", str(origin), str(clone)], cwd=tmp_path)
+    monkeypatch.chdir(clone)
+    head = git(["rev-parse", "HEAD"], cwd=clone)
+    git(["update-ref", "refs/remotes/origin/archive/old", head], cwd=clone)
+    monkeypatch.setattr("refs.remote_branches", lambda _: None)
+    heads = status.remote_heads({"main", "feature/a"})
+    assert sorted(heads) == ["feature/a", "main"]
+
+
+def test_status_runs_with_the_merge_options(origin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GIT_LFS_SKIP_SMUDGE", "0")
+    monkeypatch.setattr(utils, "command_log_dir", None)
+    seen = {}
+    clone = gam.clone
+
+    def record_lfs_mode():
+        seen["lfs"] = os.environ["GIT_LFS_SKIP_SMUDGE"]
+        clone()
+
+    monkeypatch.setattr(gam, "clone", record_lfs_mode)
+    args = [*status_args(origin, tmp_path), "--lfs", "--command-log-dir", "logs", "status"]
+    result = CliRunner().invoke(gam.cli, args)
+    assert result.exit_code == 0, result.output
+    assert "develop" in result.stdout
+    assert seen["lfs"] == "1"
+    assert list((tmp_path / "logs").iterdir())
+
+
+def test_status_of_a_big_plan_runs_a_constant_number_of_commands(origin, tmp_path, monkeypatch):
+    clone = tmp_path / "clone"
+    git(["clone", str(origin), str(clone)], cwd=tmp_path)
+    monkeypatch.chdir(clone)
+    head = git(["rev-parse", "HEAD"], cwd=clone)
+    features = [f"feature/{index}" for index in range(5000)]
+    create = "".join(f"create refs/remotes/origin/{branch} {head}\n" for branch in features)
+    subprocess.run(["git", "update-ref", "--stdin"], input=create, text=True, cwd=clone, check=True)
+    root = gam.MergeItem(group="root", branch_name="main")
+    for branch in features:
+        root.add_downstream_branch(branch, group="feature")
+    graph = plan_graph.build_graph(root)
+    with patch("utils.execute_shell", wraps=utils.execute_shell) as execute_shell:
+        rows = status.edge_status(graph)
+    assert len(rows) == 5000
+    assert all((row["behind"], row["ahead"]) == (0, 0) for row in rows)
+    assert execute_shell.call_count <= 3
+    # the for-each-ref of newer git doesn't name the 5,000 downstream refs either
+    output = "\n".join(f"{branch} 0 0" for branch in features)
+    with patch("utils.execute_shell", return_value=output) as execute_shell:
+        assert len(status.ahead_behind(graph.edges())) == 5000
+    assert len(execute_shell.call_args.args[0]) < 200
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import transport
+import utils
+
+FAKE_SSH = """#!/bin/sh
+# stands in for ssh: a "master" file marks the control master as running
+echo "$@" >> "$(dirname "$0")/calls"
+case "$*" in
+  *"-O check"*) [ -e "$(dirname "$0")/master" ] ;;
+  *"-O exit"*) rm -f "$(dirname "$0")/master" ;;
+  *" -M "*) [ -e "$(dirname "$0")/refuse" ] || touch "$(dirname "$0")/master" ;;
+  # like ssh with ControlPersist: a new master forks off holding the caller's output
+  *"ControlMaster=auto"*) [ -e "$(dirname "$0")/master" ] || { sleep 60 & } ; echo remote ;;
+  *) echo remote ;;
+esac
+"""
+
+
+def test_ssh_destination():
+    assert transport.ssh_destination("git@github.com:org/repo.git") == ("git@github.com", None)
+    assert transport.ssh_destination("ssh://git@host:2222/repo.git") == ("git@host", 2222)
+    assert transport.ssh_destination("host:repo.git") == ("host", None)
+    assert transport.ssh_destination("https://github.com/org/repo.git") is None
+    assert transport.ssh_destination("/srv/git/repo.git") is None
+
+
+def test_one_master_serves_every_operation_and_is_torn_down(tmp_path, monkeypatch):
+    fake_ssh = tmp_path / "ssh"
+    fake_ssh.write_text(FAKE_SSH, encoding="utf-8")
+    fake_ssh.chmod(0o755)
+    monkeypatch.setenv("GIT_SSH_COMMAND", str(fake_ssh))
+    monkeypatch.setattr(transport, "MAX_SOCKET_DIR_LENGTH", 1000)
+    sockets = tmp_path / "s"
+    mux = transport.start("git@example.com:org/repo.git", str(sockets))
+    try:
+        assert os.environ["GIT_SSH_COMMAND"].startswith(f"{fake_ssh} -o ControlMaster=no")
+        assert f"ControlPath='{sockets}/%C'" in os.environ["GIT_SSH_COMMAND"]
+        assert "ControlPersist" not in os.environ["GIT_SSH_COMMAND"]
+        transport.connect("clone")
+        transport.connect("push develop")
+        (sockets / "0123abcd").touch()
+    finally:
+        transport.stop()
+    assert os.environ["GIT_SSH_COMMAND"] == str(fake_ssh)
+    calls = (tmp_path / "calls").read_text(encoding="utf-8").splitlines()
+    assert ["-O check" in call for call in calls] == [True, False, True, False]
+    assert " -M -N -f git@example.com" in calls[1]
+    assert calls[3].endswith(f"-o ControlPath={sockets}/0123abcd -O exit git@example.com")
+    assert not (tmp_path / "master").exists()
+    assert mux.destination == "git@example.com"
+    assert transport.session is None
+
+
+def test_git_connects_directly_when_no_master_could_be_opened(tmp_path, monkeypatch):
+    fake_ssh = tmp_path / "ssh"
+    fake_ssh.write_text(FAKE_SSH, encoding="utf-8")
+    fake_ssh.chmod(0o755)
+    (tmp_path / "refuse").touch()
+    monkeypatch.setenv("GIT_SSH_COMMAND", str(fake_ssh))
+    monkeypatch.setattr(transport, "MAX_SOCKET_DIR_LENGTH", 1000)
+    transport.start("git@example.com:org/repo.git", str(tmp_path / "s"))
+    try:
+        transport.connect("fetch")
+        assert not (tmp_path / "master").exists()
+        command = "$GIT_SSH_COMMAND git@example.com git-upload-pack repo.git"
+        assert utils.execute_shell(command, timeout=10) == "remote"
+    finally:
+        transport.stop()
+
+
+def test_long_work_dirs_get_a_short_socket_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+    mux = transport.SshMux("git@example.com", None, str(tmp_path / ("d" * 60)))
+    assert mux.owns_socket_dir
+    assert len(mux.socket_dir) <= transport.MAX_SOCKET_DIR_LENGTH
+    mux.start()
+    mux.stop()
+    assert not os.path.exists(mux.socket_dir)
+    assert "GIT_SSH_COMMAND" not in os.environ
+
+
+@pytest.mark.parametrize("url", ["https://github.com/org/repo.git", "/srv/git/repo.git"])
+def test_non_ssh_remotes_are_left_alone(url, monkeypatch):
+    monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+    assert transport.start(url, "ssh") is None
+    transport.connect("clone")
+    transport.stop()
+    assert "GIT_SSH_COMMAND" not in os.environ
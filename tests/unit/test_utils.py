@@ -1,25 +1,43 @@
-from subprocess import CalledProcessError, CompletedProcess
+import io
+import json
+import time
+from subprocess import CalledProcessError
 from unittest.mock import patch
 
+import pytest
+
 from git_auto_merge import utils
 
 
-@patch("git_auto_merge.utils.run")
-def test_execute_shell(run_mock):
-    run_mock.side_effect = run_func
+class FakePopen:
+    def __init__(self, command, returncode=0, stdout=""):
+        self.args = command
+        self.returncode = returncode
+        self.stdout = io.StringIO(stdout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+@patch("git_auto_merge.utils.Popen")
+def test_execute_shell(popen_mock):
+    popen_mock.side_effect = popen_func
     utils.execute_shell(["asdf"])
 
 
-def run_func(command, shell, cwd, stderr, check, stdout, universal_newlines):
+def popen_func(command, shell, cwd, stderr, stdout, universal_newlines, start_new_session):
     length = len(command)
     assert length > 0
     assert command[0] == "asdf"
-    return CompletedProcess(args=command, returncode=0, stdout="")
+    return FakePopen(command)
 
 
-@patch("git_auto_merge.utils.run")
-def test_execute_shell_handles_errors(run_mock):
-    run_mock.side_effect = run_error_func
+@patch("git_auto_merge.utils.Popen")
+def test_execute_shell_handles_errors(popen_mock):
+    popen_mock.side_effect = popen_error_func
     try:
         utils.execute_shell(["expecting error"])
         assert False, "expected CalledProcessError"
@@ -27,10 +45,70 @@ def test_execute_shell_handles_errors(run_mock):
         pass
 
 
-def run_error_func(command, shell, cwd, stderr, check, stdout, universal_newlines):
-    raise CalledProcessError(0, command)
+def popen_error_func(command, shell, cwd, stderr, stdout, universal_newlines, start_new_session):
+    return FakePopen(command, returncode=1, stdout="fatal: expecting error\n")
 
 
 def test_execute_shell_handles_pwd():
     pwd = utils.execute_shell(["pwd"])
     assert pwd
+
+
+def test_span_records_chrome_trace_event():
+    utils.clear_trace()
+    with utils.span("clone", edge="main -> develop"):
+        pass
+    event = utils.trace_events[-1]
+    assert event["name"] == "clone"
+    assert event["cat"] == "stage"
+    assert event["ph"] == "X"
+    assert event["dur"] >= 0
+    assert event["args"] == {"edge": "main -> develop"}
+
+
+def test_execute_shell_records_span_and_writes_trace(tmp_path):
+    utils.clear_trace()
+    utils.execute_shell("true")
+    path = tmp_path / "profile" / "trace.json"
+    utils.write_trace(str(path))
+    with open(path, encoding="utf-8") as file:
+        trace = json.load(file)
+    assert [event["cat"] for event in trace["traceEvents"]] == ["shell"]
+    assert trace["traceEvents"][0]["name"] == "true"
+
+
+def test_execute_shell_keeps_only_the_tail_and_logs_everything(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "command_log_dir", str(tmp_path))
+    output = utils.execute_shell("seq 1 1000", max_lines=3)
+    assert output == "998\n999\n1000"
+    [log_file] = tmp_path.iterdir()
+    assert log_file.name.endswith("seq-1-1000.log")
+    assert len(log_file.read_text(encoding="utf-8").splitlines()) == 1000
+
+
+def test_execute_shell_returns_the_whole_output_by_default():
+    output = utils.execute_shell(f"seq 1 {utils.DEFAULT_MAX_LINES * 3}")
+    assert output.splitlines() == [str(line) for line in range(1, utils.DEFAULT_MAX_LINES * 3 + 1)]
+
+
+def test_execute_shell_error_output_notes_truncation():
+    with pytest.raises(CalledProcessError) as err:
+        utils.execute_shell("seq 1 100; exit 3", max_lines=2)
+    assert err.value.returncode == 3
+    assert err.value.output == "[... 98 earlier lines omitted ...]\n99\n100"
+
+
+def test_execute_shell_kills_the_process_group_on_timeout():
+    start = time.monotonic()
+    with pytest.raises(utils.CommandTimeout) as err:
+        # the inner sleep keeps stdout open unless the whole group is killed
+        utils.execute_shell("echo started; sh -c 'sleep 30'", timeout=0.5)
+    assert time.monotonic() - start < 10
+    assert err.value.timeout == 0.5
+    assert err.value.output == "started"
+    assert "timed out after 0.5 seconds" in str(err.value)
+
+
+def test_excerpt():
+    assert utils.excerpt("a\nb", max_lines=2) == "a\nb"
+    assert utils.excerpt("a\nb\nc", max_lines=2) == "[... 1 lines omitted ...]\nb\nc"